@@ -0,0 +1,196 @@
+import os
+import gzip
+import json
+import logging
+import tempfile
+from datetime import datetime, timedelta, timezone
+from typing import Dict, Any, List, Iterator, Tuple
+
+import boto3
+
+try:  # when the common Lambda layer is installed
+    from archive import compacted_archive_key, read_archived_objects, stream_archived_entries
+except ImportError:  # when Lambda handler is imported in another file
+    from common.archive import compacted_archive_key, read_archived_objects, stream_archived_entries
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+COMPACTION_WORKERS = 16
+DELETE_BATCH_SIZE = 1000  # maximum number of keys per DeleteObjects request
+
+
+def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str, Any]:
+    """Compact a day's archived records into a single compressed JSON Lines object
+
+    All objects archived under '{table}/{date}/' (see dynamo_archive), both
+    single-record objects and spool objects, are merged into the object
+    'compacted/{table}/{date}.jsonl.gz', one record per line, together with a
+    sorted id index at 'compacted/{table}/{date}.index.json'. Records of an
+    existing compacted object for the same day are carried over, so late
+    arrivals can be compacted by running the job again; the existing object is
+    streamed, so it is never held in memory as a whole. The compacted object is
+    uploaded to a temporary key and verified before it is copied over the final
+    key, so a failed verification never replaces the last good compacted object.
+    Once the compacted object is in place, the original objects are deleted.
+
+    The day is taken from the event's 'date' field (YYYY-MM-DD) and defaults
+    to yesterday (UTC), so the function can be invoked by a daily schedule.
+    Archived objects are read in parallel by 'COMPACTION_WORKERS' threads,
+    keeping at most twice as many objects in memory at once.
+
+    The environment variables 'ARCHIVE_BUCKET' and 'TABLE_NAME' specify the
+    archiving S3 bucket and the archived DynamoDB table.
+
+    :param event: deserialized Lambda function event
+    :type event: dict
+    :param context: Lambda function context
+    :type context: LambdaContext
+
+    :raises KeyError: environment variable 'ARCHIVE_BUCKET' or 'TABLE_NAME' is not defined
+    :raises RuntimeError: compacted object failed verification
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    bucket_name = os.environ.get('ARCHIVE_BUCKET')
+    table_name = os.environ.get('TABLE_NAME')
+    workers = int(os.environ.get('COMPACTION_WORKERS', COMPACTION_WORKERS))
+    date = event.get('date') or (datetime.now(timezone.utc) - timedelta(days=1)).strftime('%Y-%m-%d')
+
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(bucket_name)
+    keys = [summary.key for summary in bucket.objects.filter(Prefix=f'{table_name}/{date}/')]
+    if not keys:
+        response = {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': f"No archived objects to compact in s3://{bucket_name}/{table_name}/{date}/",
+                'objects': 0,
+                'records': 0
+            })
+        }
+        logger.info(response)
+        return response
+
+    compacted_key = compacted_archive_key(table_name, date)
+    index_key = compacted_key[:-len('.jsonl.gz')] + '.index.json'
+    upload_key = compacted_key + '.upload'
+    with tempfile.TemporaryDirectory() as directory:
+        path = os.path.join(directory, 'compacted.jsonl.gz')
+        index = write_compacted(bucket, compacted_key, keys, path, workers)
+        bucket.upload_file(path, upload_key)
+        try:
+            verify_compacted(bucket, upload_key, os.path.getsize(path), len(index))
+            bucket.copy({'Bucket': bucket.name, 'Key': upload_key}, compacted_key)
+        finally:
+            bucket.Object(upload_key).delete()
+
+    bucket.put_object(Key=index_key, Body=json.dumps({'ids': index}))
+    for start in range(0, len(keys), DELETE_BATCH_SIZE):  # delete the compacted originals
+        delete_list = [{'Key': key} for key in keys[start:start + DELETE_BATCH_SIZE]]
+        result = bucket.delete_objects(Delete={'Objects': delete_list, 'Quiet': True})
+        for error in result.get('Errors', []):
+            logger.error(error)
+
+    response = {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f"Successfully compacted to s3://{bucket_name}/{compacted_key}",
+            'objects': len(keys),
+            'records': len(index)
+        })
+    }
+    logger.info(response)
+    return response
+
+
+def write_compacted(bucket: 'boto3.resources.factory.s3.Bucket', compacted_key: str, keys: List[str],
+                    path: str, workers: int) -> List[Tuple[str, int]]:
+    """Write archived records to a local compressed JSON Lines file
+
+    Each line holds an archived record's original 'key', stream 'sequence'
+    number and typed 'image'. Records archived more than once, e.g. both as
+    a single object and in a spool, are only written once.
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param compacted_key: S3 key of a previously compacted object to carry over
+    :type compacted_key: str
+    :param keys: S3 keys of the archived objects
+    :type keys: list
+    :param path: path of the local file to write
+    :type path: str
+    :param workers: number of parallel S3 reads
+    :type workers: int
+
+    :return: (id, line number) pairs of the written records, sorted by id
+    :rtype: list
+    """
+    sequences = set()
+    index = []
+    with gzip.open(path, 'wt') as compacted_file:
+        for entry in read_compacted_entries(bucket, compacted_key, keys, workers):
+            if entry['sequence'] in sequences:
+                continue
+            sequences.add(entry['sequence'])
+            index.append((list(entry['image']['id'].values())[0], len(index)))
+            compacted_file.write(json.dumps(entry) + '\n')
+
+    index.sort()
+    return index
+
+
+def read_compacted_entries(bucket: 'boto3.resources.factory.s3.Bucket', compacted_key: str, keys: List[str],
+                           workers: int) -> Iterator[Dict[str, Any]]:
+    """Read the entries of a previously compacted object, if any, and of archived objects
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param compacted_key: S3 key of a previously compacted object
+    :type compacted_key: str
+    :param keys: S3 keys of the archived objects
+    :type keys: list
+    :param workers: number of parallel S3 reads
+    :type workers: int
+
+    :return: archived record entries
+    :rtype: Iterator[dict]
+    """
+    try:
+        body = bucket.Object(compacted_key).get()['Body']
+    except bucket.meta.client.exceptions.NoSuchKey:
+        pass
+    else:
+        yield from stream_archived_entries(body)
+
+    for _, entries in read_archived_objects(bucket, keys, workers):
+        yield from entries
+
+
+def verify_compacted(bucket: 'boto3.resources.factory.s3.Bucket', key: str, size: int, records: int) -> None:
+    """Verify an uploaded compacted object against the local file it was uploaded from
+
+    The object's size must match and its content must decompress into the expected
+    number of records.
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param key: S3 key of the compacted object
+    :type key: str
+    :param size: size of the local compacted file in bytes
+    :type size: int
+    :param records: number of records written to the compacted file
+    :type records: int
+
+    :raises RuntimeError: compacted object failed verification
+    """
+    compacted_object = bucket.Object(key)
+    if compacted_object.content_length != size:
+        raise RuntimeError(f"Compacted object {key} is {compacted_object.content_length} bytes, expected {size}")
+
+    with gzip.GzipFile(fileobj=compacted_object.get()['Body']) as compacted_file:
+        count = sum(1 for _ in compacted_file)
+    if count != records:
+        raise RuntimeError(f"Compacted object {key} holds {count} records, expected {records}")
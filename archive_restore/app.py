@@ -0,0 +1,308 @@
+import os
+import json
+import hashlib
+import logging
+import itertools
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+from typing import Dict, Any, List, Optional, Set
+
+import boto3
+from boto3.dynamodb.types import TypeDeserializer
+
+try:  # when the common Lambda layer is installed
+    from archive import compacted_archive_key, read_archived_objects, stream_archived_entries
+    from batching import BatchWriter, BATCH_WRITE_SIZE
+    from expiry import expiration_time
+    from resilience import Resilience, ServiceUnavailableError, TokenBucket
+except ImportError:  # when Lambda handler is imported in another file
+    from common.archive import compacted_archive_key, read_archived_objects, stream_archived_entries
+    from common.batching import BatchWriter, BATCH_WRITE_SIZE
+    from common.expiry import expiration_time
+    from common.resilience import Resilience, ServiceUnavailableError, TokenBucket
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+RESTORE_WORKERS = 16
+RESTORE_WRITE_RATE = 100  # items per second
+RESTORE_TIME_MARGIN = 30000  # milliseconds left to the Lambda timeout when a restore is suspended
+RESTORE_CHECKPOINT_LINES = 1000  # lines of a compacted archive restored between checkpoints
+CHECKPOINT_PREFIX = 'restore-checkpoints'
+
+# DynamoDB and S3 calls are retried, rate limited and circuit broken per container
+resilience = Resilience('archive_restore')
+# Created once per container, so botocore's adaptive rate limiter persists across invocations
+s3 = boto3.resource('s3', config=resilience.client_config())
+dynamodb = boto3.resource('dynamodb', config=resilience.client_config())
+
+deserializer = TypeDeserializer()
+
+
+def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str, Any]:
+    """Restore archived records of a time window from the S3 archive into DynamoDB
+
+    The event specifies the window's first and last days in the fields 'start'
+    and 'end' (YYYY-MM-DD, 'end' defaults to 'start') and may restrict the restore
+    to a list of record 'ids'. With 'dry_run' set, nothing is written and the
+    response reports how many records would be restored.
+
+    The archive objects of each day (see dynamo_archive and archive_compaction)
+    are listed in parallel. A day's compacted archive is streamed line by line,
+    while the other objects are read in parallel windows. Their typed images are
+    deserialized and given a new 'expiration_time', like items written by
+    dynamo_operations, and written with BatchWriteItem at no more than
+    'RESTORE_WRITE_RATE' items per second.
+
+    Progress is checkpointed to 's3://{bucket}/restore-checkpoints/{restore_id}.json'
+    after every window of objects and every 'RESTORE_CHECKPOINT_LINES' lines of a
+    compacted archive, whose checkpoint holds the number of restored lines; the
+    remaining time is checked after every batch of writes. If the invocation is
+    about to time out or DynamoDB is unavailable, the restore is suspended with 'complete' set to
+    false; invoking the function again with the same event resumes it. The
+    'restore_id' may be passed in the event and defaults to a digest of the
+    event's window, ids and dry run flag.
+
+    The environment variables 'ARCHIVE_BUCKET' and 'TABLE_NAME' specify the
+    archiving S3 bucket and the DynamoDB table to restore into.
+
+    :param event: deserialized Lambda function event
+    :type event: dict
+    :param context: Lambda function context
+    :type context: LambdaContext
+
+    :raises KeyError: environment variable 'ARCHIVE_BUCKET' or 'TABLE_NAME' is not defined
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    bucket_name = os.environ.get('ARCHIVE_BUCKET')
+    table_name = os.environ.get('TABLE_NAME')
+    workers = int(os.environ.get('RESTORE_WORKERS', RESTORE_WORKERS))
+    write_rate = float(os.environ.get('RESTORE_WRITE_RATE', RESTORE_WRITE_RATE))
+    start = event['start']
+    end = event.get('end') or start
+    ids = set(event['ids']) if event.get('ids') else None
+    dry_run = bool(event.get('dry_run', False))
+    restore_id = event.get('restore_id') or hashlib.sha1(json.dumps(
+        [start, end, sorted(ids) if ids is not None else None, dry_run]
+    ).encode('utf-8')).hexdigest()[:16]
+
+    resilience.bind(context)
+    bucket = s3.Bucket(bucket_name)
+    writer = BatchWriter(dynamodb, table_name, resilience, TokenBucket(write_rate), dry_run)
+
+    checkpoint_key = f'{CHECKPOINT_PREFIX}/{restore_id}.json'
+    checkpoint = load_checkpoint(bucket, checkpoint_key)
+    writer.written = checkpoint['restored']
+    days = [day for day in archive_days(start, end) if day not in checkpoint['completed']]
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        listings = list(executor.map(
+            lambda day: list_archived_keys(bucket, table_name, day, checkpoint['positions'].get(day)), days
+        ))
+
+    window = 2 * workers
+    complete = True
+    try:
+        for day, keys in zip(days, listings):
+            position = checkpoint['positions'].get(day) or {}
+            if keys and keys[0] == compacted_archive_key(table_name, day):  # stream the compacted archive
+                body = bucket.Object(keys[0]).get()['Body']
+                lines = enumerate(stream_archived_entries(body), start=1)
+                for line, entry in itertools.islice(lines, position.get('line', 0), None):
+                    restore_entry(writer, entry, ids, checkpoint)
+                    if line % RESTORE_CHECKPOINT_LINES != 0 and (line % BATCH_WRITE_SIZE != 0
+                                                                 or not out_of_time(context)):
+                        continue
+
+                    checkpoint['positions'][day] = {'key': keys[0], 'line': line}
+                    save_progress(writer, bucket, checkpoint_key, checkpoint, dry_run)
+                    if out_of_time(context):
+                        raise TimeoutError(f'Restore {restore_id} suspended before the Lambda timeout')
+                checkpoint['positions'][day] = {'key': keys.pop(0)}
+
+            objects = read_archived_objects(bucket, keys, workers)
+            for count, (key, entries) in enumerate(objects, start=1):
+                for entry in entries:
+                    restore_entry(writer, entry, ids, checkpoint)
+                checkpoint['positions'][day] = {'key': key}
+                if count % window != 0 and count != len(keys) and not out_of_time(context):
+                    continue
+
+                save_progress(writer, bucket, checkpoint_key, checkpoint, dry_run)
+                if out_of_time(context):
+                    objects.close()
+                    raise TimeoutError(f'Restore {restore_id} suspended before the Lambda timeout')
+
+            checkpoint['completed'].append(day)
+            checkpoint['positions'].pop(day, None)
+            save_progress(writer, bucket, checkpoint_key, checkpoint, dry_run)
+    except (TimeoutError, ServiceUnavailableError) as e:
+        logger.warning(e)
+        complete = False
+    finally:
+        resilience.metrics.flush()
+
+    response = {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': (f"{'Dry run of restore' if dry_run else 'Restore'} {restore_id} "
+                        f"{'completed' if complete else 'suspended'} from s3://{bucket_name}"),
+            'restore_id': restore_id,
+            'complete': complete,
+            'dry_run': dry_run,
+            'restored': checkpoint['restored'],
+            'skipped': checkpoint['skipped']
+        })
+    }
+    logger.info(response)
+    return response
+
+
+def archive_days(start: str, end: str) -> List[str]:
+    """List the days of a time window
+
+    :param start: first day (YYYY-MM-DD)
+    :type start: str
+    :param end: last day (YYYY-MM-DD)
+    :type end: str
+
+    :return: days of the window (YYYY-MM-DD)
+    :rtype: list
+    """
+    first, last = date.fromisoformat(start), date.fromisoformat(end)
+    return [(first + timedelta(days=offset)).isoformat() for offset in range((last - first).days + 1)]
+
+
+def restore_entry(writer: BatchWriter, entry: Dict[str, Any], ids: Optional[Set[str]],
+                  checkpoint: Dict[str, Any]) -> None:
+    """Buffer the write of an archived record, unless its id is not restored
+
+    :param writer: batch writer of the restored items
+    :type writer: BatchWriter
+    :param entry: archived record entry
+    :type entry: dict
+    :param ids: ids of the restored records, or None to restore all records
+    :type ids: set
+    :param checkpoint: restore checkpoint, whose skipped records are counted
+    :type checkpoint: dict
+
+    :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+    """
+    item = {name: deserializer.deserialize(value) for name, value in entry['image'].items()}
+    if ids is not None and item['id'] not in ids:
+        checkpoint['skipped'] += 1
+        return
+    item['expiration_time'] = expiration_time(os.environ.get('AWS_REGION'))
+    item.pop('_etag', None)  # the content changed, so reads recompute the ETag
+    writer.put(item)
+
+
+def save_progress(writer: BatchWriter, bucket: 'boto3.resources.factory.s3.Bucket', key: str,
+                  checkpoint: Dict[str, Any], dry_run: bool) -> None:
+    """Write all buffered items and save the restore's checkpoint
+
+    :param writer: batch writer of the restored items
+    :type writer: BatchWriter
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param key: S3 key of the checkpoint
+    :type key: str
+    :param checkpoint: restore checkpoint
+    :type checkpoint: dict
+    :param dry_run: whether the restore is a dry run
+    :type dry_run: bool
+
+    :raises ServiceUnavailableError: DynamoDB or S3 is throttling or unavailable
+    """
+    writer.flush()
+    checkpoint['restored'] = writer.written
+    save_checkpoint(bucket, key, checkpoint, dry_run)
+
+
+def out_of_time(context: Optional['LambdaContext']) -> bool:
+    """Check whether the invocation is close enough to its timeout to suspend the restore
+
+    :param context: Lambda function context or None for no time limit
+    :type context: LambdaContext
+
+    :return: True if less than 'RESTORE_TIME_MARGIN' milliseconds are left
+    :rtype: bool
+    """
+    return context is not None and context.get_remaining_time_in_millis() < RESTORE_TIME_MARGIN
+
+
+def list_archived_keys(bucket: 'boto3.resources.factory.s3.Bucket', table_name: str, day: str,
+                       position: Optional[Dict[str, Any]]) -> List[str]:
+    """List the keys of a day's archive objects, in the order they are restored
+
+    The day's compacted archive, if any, is restored first, followed by the
+    objects under '{table}/{day}/' in key order. A compacted archive which has
+    only partly been restored, i.e. whose position holds a 'line', is listed again.
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param table_name: archived DynamoDB table name
+    :type table_name: str
+    :param day: archive day (YYYY-MM-DD)
+    :type day: str
+    :param position: checkpointed position of the day, with the 'key' of the last restored object
+    :type position: dict
+
+    :return: S3 object keys
+    :rtype: list
+    """
+    keys = []
+    compacted_key = compacted_archive_key(table_name, day)
+    after = position['key'] if position is not None and 'line' not in position else None
+    if after is None:
+        keys += [summary.key for summary in bucket.objects.filter(Prefix=compacted_key) if summary.key == compacted_key]
+
+    prefix = f'{table_name}/{day}/'
+    if after is None or after == compacted_key:
+        summaries = bucket.objects.filter(Prefix=prefix)
+    else:
+        summaries = bucket.objects.filter(Prefix=prefix, Marker=after)
+    return keys + [summary.key for summary in summaries]
+
+
+def load_checkpoint(bucket: 'boto3.resources.factory.s3.Bucket', key: str) -> Dict[str, Any]:
+    """Load a restore's checkpoint, or start a new one
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param key: S3 key of the checkpoint
+    :type key: str
+
+    :return: completed days, the position of each day in progress and counters
+    :rtype: dict
+    """
+    try:
+        return json.loads(bucket.Object(key).get()['Body'].read())
+    except bucket.meta.client.exceptions.NoSuchKey:
+        return {
+            'completed': [],
+            'positions': {},
+            'restored': 0,
+            'skipped': 0
+        }
+
+
+def save_checkpoint(bucket: 'boto3.resources.factory.s3.Bucket', key: str, checkpoint: Dict[str, Any],
+                    dry_run: bool) -> None:
+    """Save a restore's checkpoint; dry runs are never checkpointed
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param key: S3 key of the checkpoint
+    :type key: str
+    :param checkpoint: restore checkpoint
+    :type checkpoint: dict
+    :param dry_run: whether the restore is a dry run
+    :type dry_run: bool
+
+    :raises ServiceUnavailableError: S3 is throttling or unavailable
+    """
+    if not dry_run:
+        resilience.call(bucket.put_object, Key=key, Body=json.dumps(checkpoint))
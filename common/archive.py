@@ -0,0 +1,91 @@
+import gzip
+import json
+import posixpath
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, Any, List, Iterator, Tuple
+
+
+COMPACTED_PREFIX = 'compacted'
+
+
+def compacted_archive_key(table_name: str, date: str) -> str:
+    """S3 key of a table's compacted archive of a day (see archive_compaction)
+
+    :param table_name: archived DynamoDB table name
+    :type table_name: str
+    :param date: archive day (YYYY-MM-DD)
+    :type date: str
+
+    :return: S3 object key
+    :rtype: str
+    """
+    return f'{COMPACTED_PREFIX}/{table_name}/{date}.jsonl.gz'
+
+
+def parse_archived_object(key: str, body: bytes) -> List[Dict[str, Any]]:
+    """Parse the archived record entries of an S3 object
+
+    Objects ending in '.jsonl.gz' (spools and compacted archives) hold one
+    entry per line. Any other object holds a single record's typed image and
+    is named '{id}_{sequence number}.json' (see dynamo_archive). Each entry
+    holds the record's archive 'key', stream 'sequence' number and typed 'image'.
+
+    :param key: S3 object key
+    :type key: str
+    :param body: S3 object content
+    :type body: bytes
+
+    :return: archived record entries
+    :rtype: list
+    """
+    if key.endswith('.jsonl.gz'):
+        return [json.loads(line) for line in gzip.decompress(body).splitlines()]
+
+    sequence = posixpath.basename(key)[:-len('.json')].rsplit('_', 1)[1]
+    return [{
+        'key': key,
+        'sequence': sequence,
+        'image': json.loads(body)
+    }]
+
+
+def stream_archived_entries(body: 'botocore.response.StreamingBody') -> Iterator[Dict[str, Any]]:
+    """Parse the record entries of a '.jsonl.gz' archive object while it is downloaded
+
+    Only one line of the object is decompressed and held in memory at a time.
+
+    :param body: streaming S3 object content
+    :type body: botocore.response.StreamingBody
+
+    :return: archived record entries
+    :rtype: Iterator[dict]
+    """
+    with gzip.GzipFile(fileobj=body) as archive_file:
+        for line in archive_file:
+            yield json.loads(line)
+
+
+def read_archived_objects(bucket: 'boto3.resources.factory.s3.Bucket', keys: List[str],
+                          workers: int) -> Iterator[Tuple[str, List[Dict[str, Any]]]]:
+    """Read and parse archived S3 objects in parallel, in the order of their keys
+
+    Objects are fetched in windows of twice the number of workers, which
+    bounds the number of objects held in memory.
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param keys: S3 keys of the archived objects
+    :type keys: list
+    :param workers: number of parallel S3 reads
+    :type workers: int
+
+    :return: pairs of S3 object key and archived record entries
+    :rtype: Iterator[tuple]
+    """
+    window = 2 * workers
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for start in range(0, len(keys), window):
+            window_keys = keys[start:start + window]
+            bodies = executor.map(lambda key: bucket.Object(key).get()['Body'].read(), window_keys)
+            for key, body in zip(window_keys, bodies):
+                yield key, parse_archived_object(key, body)
@@ -0,0 +1,163 @@
+import time
+import random
+from typing import Dict, Any, List, Optional, Tuple
+
+import botocore.exceptions
+
+try:  # when the common Lambda layer is installed
+    from resilience import Resilience, ServiceUnavailableError, TokenBucket
+except ImportError:  # when imported from the repository's root
+    from common.resilience import Resilience, ServiceUnavailableError, TokenBucket
+
+
+BATCH_WRITE_SIZE = 25  # maximum number of requests per BatchWriteItem request
+MAX_UNPROCESSED_RETRIES = 8
+
+# Errors of write requests DynamoDB or botocore will always reject, e.g. of items with a mistyped key
+REJECTED_ERRORS = (botocore.exceptions.ClientError, botocore.exceptions.ParamValidationError)
+
+
+class BatchWriter:
+    """Writer coalescing puts and deletes into BatchWriteItem requests
+
+    Write requests are buffered per primary key ('id'): a later put or delete
+    of a buffered key replaces the buffered request, so only the last write
+    of each key is sent. Once 25 keys are buffered they are written in a
+    single BatchWriteItem request. Requests left unprocessed by DynamoDB are
+    retried with exponential backoff.
+
+    With 'isolate_rejected' set, a batch DynamoDB rejects as a whole is split
+    in halves until the rejected requests are isolated; the other requests are
+    written and the keys of the rejected ones are kept in 'rejected' together
+    with their errors, instead of the error being raised.
+
+    :param dynamodb: boto3 DynamoDB service resource
+    :type dynamodb: boto3.resources.factory.dynamodb.ServiceResource
+    :param table_name: DynamoDB table name
+    :type table_name: str
+    :param resilience: resilience policy the requests are made through
+    :type resilience: Resilience
+    :param rate_limiter: token bucket of requests written per second, if limited
+    :type rate_limiter: TokenBucket
+    :param dry_run: count the requests instead of writing them
+    :type dry_run: bool
+    :param isolate_rejected: isolate and keep the requests DynamoDB rejects instead of raising
+    :type isolate_rejected: bool
+    """
+
+    def __init__(self, dynamodb: 'boto3.resources.factory.dynamodb.ServiceResource', table_name: str,
+                 resilience: Resilience, rate_limiter: Optional[TokenBucket] = None, dry_run: bool = False,
+                 isolate_rejected: bool = False) -> None:
+        self.dynamodb = dynamodb
+        self.table_name = table_name
+        self.resilience = resilience
+        self.rate_limiter = rate_limiter
+        self.dry_run = dry_run
+        self.isolate_rejected = isolate_rejected
+        self.pending: Dict[Any, Dict[str, Any]] = {}
+        self.written = 0
+        self.rejected: List[Tuple[Any, Exception]] = []
+
+    def put(self, item: Dict[str, Any]) -> None:
+        """Buffer an item put, writing a batch once enough keys are buffered
+
+        :param item: DynamoDB item
+        :type item: dict
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        self.buffer(item['id'], {'PutRequest': {'Item': item}})
+
+    def delete(self, key: Dict[str, Any]) -> None:
+        """Buffer an item delete, writing a batch once enough keys are buffered
+
+        :param key: DynamoDB item primary key
+        :type key: dict
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        self.buffer(key['id'], {'DeleteRequest': {'Key': key}})
+
+    def buffer(self, key: Any, request: Dict[str, Any]) -> None:
+        """Buffer a write request, replacing any buffered request of the same key
+
+        :param key: primary key value
+        :type key: Any
+        :param request: BatchWriteItem put or delete request
+        :type request: dict
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        self.pending.pop(key, None)  # keep buffered requests in the order of their last write
+        self.pending[key] = request
+        if len(self.pending) >= BATCH_WRITE_SIZE:
+            self.flush()
+
+    def flush(self) -> None:
+        """Write all buffered requests
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        pending = list(self.pending.items())
+        for start in range(0, len(pending), BATCH_WRITE_SIZE):
+            if self.isolate_rejected:
+                self.write_isolating(pending[start:start + BATCH_WRITE_SIZE])
+            else:
+                self.write_batch([request for _, request in pending[start:start + BATCH_WRITE_SIZE]])
+        self.pending = {}
+
+    def write_isolating(self, batch: List[Tuple[Any, Dict[str, Any]]]) -> None:
+        """Write a batch of requests, splitting it to isolate the requests DynamoDB rejects
+
+        :param batch: up to 25 pairs of primary key value and write request
+        :type batch: list
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        try:
+            self.write_batch([request for _, request in batch])
+        except REJECTED_ERRORS as e:
+            if len(batch) == 1:
+                self.rejected.append((batch[0][0], e))
+                return
+            middle = len(batch) // 2
+            self.write_isolating(batch[:middle])
+            self.write_isolating(batch[middle:])
+
+    def write_batch(self, requests: List[Dict[str, Any]]) -> None:
+        """Write a batch of requests, retrying unprocessed requests
+
+        :param requests: up to 25 write requests of distinct primary keys
+        :type requests: list
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        if self.dry_run:
+            self.written += len(requests)
+            return
+
+        if self.rate_limiter is not None:
+            self.rate_limiter.acquire(len(requests))
+        unprocessed = requests
+        for attempt in range(1, MAX_UNPROCESSED_RETRIES + 1):
+            response = self.resilience.call(self.dynamodb.batch_write_item,
+                                            RequestItems={self.table_name: unprocessed})
+            unprocessed = response.get('UnprocessedItems', {}).get(self.table_name, [])
+            if not unprocessed:
+                break
+            backoff_unprocessed(self.resilience, attempt)
+        else:
+            raise ServiceUnavailableError(f'{len(unprocessed)} write requests left unprocessed by DynamoDB', 1)
+        self.written += len(requests)
+
+
+def backoff_unprocessed(resilience: Resilience, attempt: int) -> None:
+    """Count a batch request left partly unprocessed as throttled and back off before retrying it
+
+    :param resilience: resilience policy whose throttles are counted
+    :type resilience: Resilience
+    :param attempt: number of the attempt which left requests unprocessed
+    :type attempt: int
+    """
+    resilience.metrics.increment('Throttles')
+    time.sleep(random.uniform(0, min(1.0, 0.05 * 2 ** attempt)))
@@ -0,0 +1,28 @@
+from decimal import Decimal
+from datetime import datetime, timedelta
+
+import pytz
+
+
+EXPIRY_DELTA = timedelta(days=3)
+REGION_TIMEZONES = {
+    'eu-west-1': pytz.timezone('Europe/Dublin')
+}
+
+
+def expiration_time(region: str) -> Decimal:
+    """Compute the DynamoDB TTL expiration time of an item written now
+
+    The expiration time is the AWS region's current time + a constant time
+    delta, as a UNIX epoch timestamp.
+
+    :param region: AWS region name
+    :type region: str
+
+    :raises KeyError: the region's timezone is not known
+
+    :return: UNIX epoch timestamp
+    :rtype: Decimal
+    """
+    region_tz = REGION_TIMEZONES[region]
+    return Decimal((datetime.now(region_tz) + EXPIRY_DELTA).timestamp())
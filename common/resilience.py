@@ -0,0 +1,311 @@
+import json
+import math
+import time
+import random
+from typing import Dict, Any, Callable, Optional
+
+import botocore.config
+import botocore.exceptions
+
+
+THROTTLING_ERRORS = {
+    'ThrottlingException', 'Throttling', 'ThrottledException', 'RequestThrottledException',
+    'ProvisionedThroughputExceededException', 'RequestLimitExceeded', 'TooManyRequestsException',
+    'SlowDown'
+}
+TRANSIENT_ERRORS = {
+    'InternalServerError', 'InternalError', 'ServiceUnavailable', 'RequestTimeout', 'RequestTimeoutException'
+}
+CONNECTION_ERRORS = (botocore.exceptions.ConnectionError, botocore.exceptions.HTTPClientError)
+
+MAX_ATTEMPTS = 4
+BASE_DELAY = 0.05  # seconds
+MAX_DELAY = 1.0  # seconds
+CONNECT_TIMEOUT = 1  # seconds
+READ_TIMEOUT = 3  # seconds
+TIME_SAFETY_MARGIN = 500  # milliseconds left to the Lambda timeout which are never spent on retries
+FAILURE_THRESHOLD = 5
+RESET_TIMEOUT = 30.0  # seconds
+
+
+class ServiceUnavailableError(Exception):
+    """An AWS service is throttling or failing and the call should be retried later
+
+    :param message: error message
+    :type message: str
+    :param retry_after: seconds after which the call may be retried
+    :type retry_after: int
+    """
+
+    def __init__(self, message: str, retry_after: int) -> None:
+        super().__init__(message)
+        self.retry_after = retry_after
+
+
+class CircuitBreaker:
+    """Per-container circuit breaker failing calls fast while a service is unhealthy
+
+    The circuit opens after a number of consecutive failed calls. While it is
+    open, calls are rejected without reaching the service. Once the reset
+    timeout elapses, a single trial call is let through: its success closes the
+    circuit and its failure opens it again.
+
+    :param failure_threshold: consecutive failed calls which open the circuit
+    :type failure_threshold: int
+    :param reset_timeout: seconds the circuit stays open before a trial call
+    :type reset_timeout: float
+    """
+
+    def __init__(self, failure_threshold: int = FAILURE_THRESHOLD, reset_timeout: float = RESET_TIMEOUT) -> None:
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.failures = 0
+        self.opened_at: Optional[float] = None
+        self.trial_in_progress = False
+
+    @property
+    def retry_after(self) -> int:
+        """Seconds until the open circuit lets a trial call through"""
+        if self.opened_at is None:
+            return 0
+        return max(1, math.ceil(self.opened_at + self.reset_timeout - time.monotonic()))
+
+    def before_call(self) -> None:
+        """Reject a call while the circuit is open
+
+        :raises ServiceUnavailableError: the circuit is open
+        """
+        if self.opened_at is None:
+            return
+        if time.monotonic() - self.opened_at < self.reset_timeout or self.trial_in_progress:
+            raise ServiceUnavailableError('Circuit breaker is open', self.retry_after)
+        self.trial_in_progress = True
+
+    def end_trial(self) -> None:
+        """Let another trial call through, whatever the outcome of the current one"""
+        self.trial_in_progress = False
+
+    def record_success(self) -> None:
+        """Close the circuit after a successful call"""
+        self.failures = 0
+        self.opened_at = None
+        self.trial_in_progress = False
+
+    def record_failure(self) -> None:
+        """Count a failed call, opening the circuit once the threshold is reached"""
+        self.failures += 1
+        self.trial_in_progress = False
+        if self.opened_at is not None or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+
+
+class TokenBucket:
+    """Token bucket limiting the rate of work, e.g. items written per second
+
+    :param rate: tokens added per second
+    :type rate: float
+    :param capacity: maximum tokens held, i.e. the largest burst
+    :type capacity: float
+    """
+
+    def __init__(self, rate: float, capacity: Optional[float] = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else rate
+        self.tokens = self.capacity
+        self.updated_at = time.monotonic()
+
+    def acquire(self, tokens: float = 1) -> None:
+        """Take tokens from the bucket, sleeping until enough are available
+
+        Requests for more tokens than the bucket's capacity wait for a full bucket.
+
+        :param tokens: number of tokens to take
+        :type tokens: float
+        """
+        tokens = min(tokens, self.capacity)
+        while True:
+            now = time.monotonic()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated_at) * self.rate)
+            self.updated_at = now
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return
+            time.sleep((tokens - self.tokens) / self.rate)
+
+
+class Metrics:
+    """Counters published as CloudWatch metrics in the embedded metric format
+
+    :param namespace: CloudWatch metrics namespace
+    :type namespace: str
+    :param service: value of the 'Service' metric dimension
+    :type service: str
+    """
+
+    NAMES = ('Throttles', 'Retries', 'Failures', 'CircuitOpen')
+
+    def __init__(self, namespace: str, service: str) -> None:
+        self.namespace = namespace
+        self.service = service
+        self.counters: Dict[str, int] = dict.fromkeys(self.NAMES, 0)
+
+    def increment(self, name: str, count: int = 1) -> None:
+        """Increment a counter
+
+        :param name: counter name
+        :type name: str
+        :param count: increment
+        :type count: int
+        """
+        self.counters[name] += count
+
+    def flush(self) -> None:
+        """Print the counters as an embedded metric format log line and reset them
+
+        Nothing is printed if all counters are zero.
+        """
+        if not any(self.counters.values()):
+            return
+
+        print(json.dumps({
+            '_aws': {
+                'Timestamp': int(time.time() * 1000),
+                'CloudWatchMetrics': [{
+                    'Namespace': self.namespace,
+                    'Dimensions': [['Service']],
+                    'Metrics': [{'Name': name, 'Unit': 'Count'} for name in self.NAMES]
+                }]
+            },
+            'Service': self.service,
+            **self.counters
+        }))
+        self.counters = dict.fromkeys(self.NAMES, 0)
+
+
+class Resilience:
+    """Retry, rate limiting and circuit breaking policy for AWS service calls
+
+    boto3 clients created with client_config() use botocore's adaptive retry
+    mode for its client-side token bucket rate limiter, but leave retries to
+    call(). call() retries throttled and transient errors with exponential
+    backoff and full jitter, as long as the remaining time of the bound Lambda
+    invocation fits both the backoff and a full attempt, and trips the
+    container's circuit breaker on failure. Instances are meant to live at
+    module level, so their state persists across invocations of the same
+    container.
+
+    :param service: name of the calling service, used as the metrics dimension
+    :type service: str
+    :param max_attempts: maximum attempts per call
+    :type max_attempts: int
+    :param breaker: circuit breaker guarding the calls
+    :type breaker: CircuitBreaker
+    """
+
+    def __init__(self, service: str, max_attempts: int = MAX_ATTEMPTS,
+                 breaker: Optional[CircuitBreaker] = None) -> None:
+        self.max_attempts = max_attempts
+        self.breaker = breaker or CircuitBreaker()
+        self.metrics = Metrics('ServerlessTask', service)
+        self.context: Optional['LambdaContext'] = None
+
+    def bind(self, context: Optional['LambdaContext']) -> None:
+        """Bind the current Lambda invocation's context, whose remaining time limits retries
+
+        :param context: Lambda function context or None for no time limit
+        :type context: LambdaContext
+        """
+        self.context = context
+
+    @staticmethod
+    def client_config() -> botocore.config.Config:
+        """botocore configuration of clients whose calls are made through call()
+
+        :return: botocore client configuration
+        :rtype: botocore.config.Config
+        """
+        return botocore.config.Config(
+            retries={'mode': 'adaptive', 'max_attempts': 1},
+            connect_timeout=CONNECT_TIMEOUT,
+            read_timeout=READ_TIMEOUT
+        )
+
+    def remaining_time(self) -> Optional[float]:
+        """Seconds of the bound invocation which may be spent on retries
+
+        :return: remaining seconds or None if no invocation is bound
+        :rtype: float
+        """
+        if self.context is None:
+            return None
+        return (self.context.get_remaining_time_in_millis() - TIME_SAFETY_MARGIN) / 1000
+
+    def call(self, function: Callable[..., Any], *args: Any, **kwargs: Any) -> Any:
+        """Call an AWS service function, retrying throttled and transient errors
+
+        Other client errors are raised immediately and do not count as failures
+        of the service; neither do other exceptions, e.g. parameter validation
+        errors, which never reach the service.
+
+        :param function: boto3 function to call
+        :type function: Callable
+        :param args: positional arguments of the function
+        :param kwargs: keyword arguments of the function
+
+        :raises ServiceUnavailableError: the circuit is open or the call failed after all retries
+        :raises botocore.exceptions.ClientError: non-retryable boto3 client error
+
+        :return: the function's return value
+        :rtype: Any
+        """
+        try:
+            self.breaker.before_call()
+        except ServiceUnavailableError:
+            self.metrics.increment('CircuitOpen')
+            raise
+
+        try:
+            for attempt in range(1, self.max_attempts + 1):
+                try:
+                    result = function(*args, **kwargs)
+                except botocore.exceptions.ClientError as e:
+                    if not self.is_retryable(e):
+                        self.breaker.record_success()
+                        raise
+                    error = e
+                except CONNECTION_ERRORS as e:
+                    error = e
+                else:
+                    self.breaker.record_success()
+                    return result
+
+                delay = random.uniform(0, min(MAX_DELAY, BASE_DELAY * 2 ** attempt))
+                remaining_time = self.remaining_time()
+                attempt_time = delay + CONNECT_TIMEOUT + READ_TIMEOUT  # a retry may take until the client times out
+                if attempt == self.max_attempts or (remaining_time is not None and remaining_time < attempt_time):
+                    break
+                self.metrics.increment('Retries')
+                time.sleep(delay)
+
+            self.metrics.increment('Failures')
+            self.breaker.record_failure()
+            raise ServiceUnavailableError(f'AWS service call failed after {attempt} attempts: {error}',
+                                          self.breaker.retry_after or 1) from error
+        finally:  # a trial call which failed without reaching the service lets the next call try
+            self.breaker.end_trial()
+
+    def is_retryable(self, error: botocore.exceptions.ClientError) -> bool:
+        """Check whether a client error is a throttled or transient error, counting throttles
+
+        :param error: boto3 client error
+        :type error: botocore.exceptions.ClientError
+
+        :return: True if the call may be retried
+        :rtype: bool
+        """
+        code = error.response.get('Error', {}).get('Code')
+        if code in THROTTLING_ERRORS:
+            self.metrics.increment('Throttles')
+            return True
+        status = error.response.get('ResponseMetadata', {}).get('HTTPStatusCode', 0)
+        return code in TRANSIENT_ERRORS or status >= 500
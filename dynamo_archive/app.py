@@ -1,15 +1,53 @@
 import json
 import os
 import logging
-from datetime import datetime
-from typing import Dict, Any
+import itertools
+from collections import OrderedDict
+from datetime import datetime, timezone
+from typing import Dict, Any, List, Optional
 
 import boto3
+import botocore.exceptions
+
+try:  # when Lambda handler is __main__
+    from spool import ArchiveSpool
+    from columnar import CONVERSION_ERRORS, SchemaRegistry, write_parquet
+except ImportError:  # when Lambda handler is imported in another file
+    from .spool import ArchiveSpool
+    from .columnar import CONVERSION_ERRORS, SchemaRegistry, write_parquet
+
+try:  # when the common Lambda layer is installed
+    from resilience import Resilience, ServiceUnavailableError
+except ImportError:  # when Lambda handler is imported in another file
+    from common.resilience import Resilience, ServiceUnavailableError
 
 
 logger = logging.getLogger()
 logger.setLevel(logging.INFO)
 
+# S3 and DynamoDB calls are retried, rate limited and circuit broken per container
+resilience = Resilience('dynamo_archive')
+# Created once per container, so botocore's adaptive rate limiter persists across invocations
+s3 = boto3.resource('s3', config=resilience.client_config())
+dynamodb = boto3.resource('dynamodb', config=resilience.client_config())
+
+# Registry of the Parquet archives' columns, connected on first use (see get_schema_registry)
+schema_registry: Optional[SchemaRegistry] = None
+
+# Errors after which the batch is retried from the first record which is not archived
+ARCHIVE_ERRORS = (botocore.exceptions.ClientError, ServiceUnavailableError)
+
+# Keys archived by this container, used to skip re-uploads when a failed batch is retried
+ARCHIVED_KEYS_CACHE_SIZE = 10000
+archived_keys: 'OrderedDict[str, None]' = OrderedDict()
+
+# Spool mode default, overridden by the 'ARCHIVE_SPOOL_MAX_BYTES' environment variable
+SPOOL_MAX_BYTES = 16 * 1024 * 1024
+
+# Parquet format defaults, overridden by the 'ARCHIVE_PARQUET_COMPRESSION' environment variable
+PARQUET_PREFIX = 'parquet'
+PARQUET_COMPRESSION = 'snappy'
+
 
 def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str, Any]:
     """Archive deleted records from DynamoDB stream to S3 bucket
@@ -19,6 +57,23 @@ def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str,
     event is not a 'REMOVE' event, a 500 HTTP status response is returned. In any
     case, the HTTP response is logged to CloudWatch.
 
+    Object keys are derived from the stream record alone (see archive_key), so
+    retries of a batch overwrite rather than duplicate archived objects. Records
+    already archived by this container, or already present in the bucket when the
+    environment variable 'ARCHIVE_SKIP_EXISTING' is 'true', are not uploaded again.
+    If an upload fails, the failed record's sequence number is reported in
+    'batchItemFailures', so the stream retries from that record onwards only.
+    S3 calls are made through the container's resilience policy, so throttled
+    uploads are retried within the invocation's remaining time and fail fast
+    while its circuit breaker is open.
+
+    When the environment variable 'ARCHIVE_SPOOL' is 'true', records are instead
+    archived in batches as compressed JSON Lines objects (see spool_records).
+    When the environment variable 'ARCHIVE_PARQUET' is 'true', the archived
+    records are also written in batches as Parquet files for analytics (see
+    parquet_records). Parquet files only complement the JSON archive, which is
+    what restores and compactions read, as Parquet stores numbers as doubles.
+
     The environment variable 'DESTINATION_BUCKET' specifies the target archiving
     S3 bucket.
 
@@ -34,34 +89,333 @@ def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str,
     """
     # Connect to the destination S3 bucket
     destination_bucket_name = os.environ.get('DESTINATION_BUCKET')
-    s3 = boto3.resource('s3')
     destination_bucket = s3.Bucket(destination_bucket_name)
 
+    resilience.bind(context)
+    try:
+        if os.environ.get('ARCHIVE_SPOOL', 'false').lower() == 'true':
+            response = spool_records(destination_bucket, event['Records'])
+        else:
+            response = archive_records(destination_bucket, event['Records'])
+        if os.environ.get('ARCHIVE_PARQUET', 'false').lower() == 'true' and not response.get('batchItemFailures'):
+            record_keys = json.loads(response['body']).get('records', [])
+            response = parquet_records(destination_bucket, event['Records'], record_keys)
+    finally:
+        resilience.metrics.flush()
+
+    logger.info(response)
+    return response
+
+
+def archive_records(bucket: 'boto3.resources.factory.s3.Bucket',
+                    records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Archive each DynamoDB stream record as a separate S3 object
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param records: DynamoDB stream records
+    :type records: list
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    skip_existing = os.environ.get('ARCHIVE_SKIP_EXISTING', 'false').lower() == 'true'
     record_keys = []
-    for record in event['Records']:  # archive each record in batch
+    skipped_keys = []
+    for record in records:  # archive each record in batch
         if record['eventName'] != 'REMOVE':  # invalid DynamoDB streams event
-            response = {
-                'statusCode': 500,
-                'body': json.dumps({
-                    'message': f"Invalid DynamoDB streams event passed ({record['eventName']})"
-                })
-            }
-            break
+            return invalid_event_response(record)
 
         old_image = record['dynamodb']['OldImage']
-        record_id = list(old_image['id'].values())[0]
-        record_key = f'{record_id}_{datetime.now().strftime("%Y-%m-%d %H.%M.%S.%f")}.json'
+        record_key = archive_key(record)
         record_body = json.dumps(old_image)
-        destination_bucket.put_object(Key=record_key, Body=record_body)
+        try:
+            archived = record_key in archived_keys or (skip_existing and object_exists(bucket, record_key))
+            if not archived:
+                resilience.call(bucket.put_object, Key=record_key, Body=record_body)
+        except ARCHIVE_ERRORS as e:  # retry the batch from this record
+            logger.exception(e)
+            return failed_archive_response(bucket, record_key, record_keys, record)
+
+        if archived:
+            skipped_keys.append(record_key)
+        remember_archived_key(record_key)
         record_keys.append(record_key)
-    else:
-        response = {
-            'statusCode': 200,
-            'body': json.dumps({
-                'message': f"Successfully archived to s3://{destination_bucket_name}",
-                'records': record_keys
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f"Successfully archived to s3://{bucket.name}",
+            'records': record_keys,
+            'skipped': skipped_keys
+        }),
+        'batchItemFailures': []
+    }
+
+
+def spool_records(bucket: 'boto3.resources.factory.s3.Bucket',
+                  records: List[Dict[str, Any]]) -> Dict[str, Any]:
+    """Archive DynamoDB stream records as compressed spool objects
+
+    Consecutive records removed on the same day are collected in a spool (see
+    ArchiveSpool), which is uploaded as a single object under the day's prefix
+    whenever it grows past the environment variable 'ARCHIVE_SPOOL_MAX_BYTES'
+    and at the end of the day's records. Records are only acknowledged once the
+    spool holding them has been uploaded: if an upload fails, the first record
+    of the failed spool is reported in 'batchItemFailures'.
+
+    Stream records can only be acknowledged when the invocation returns, so the
+    size of the objects is bounded by the event source mapping's batch size and
+    batching window.
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param records: DynamoDB stream records
+    :type records: list
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    max_bytes = int(os.environ.get('ARCHIVE_SPOOL_MAX_BYTES', SPOOL_MAX_BYTES))
+    invalid_record = next((record for record in records if record['eventName'] != 'REMOVE'), None)
+    valid_records = records if invalid_record is None else records[:records.index(invalid_record)]
+
+    spool_keys = []
+    for _, group in itertools.groupby(valid_records, key=removal_date):
+        group = list(group)
+        spool = ArchiveSpool()
+        for position, record in enumerate(group, start=1):
+            spool.append({
+                'key': archive_key(record),
+                'sequence': record['dynamodb']['SequenceNumber'],
+                'image': record['dynamodb']['OldImage']
             })
-        }
+            if spool.size < max_bytes and position != len(group):
+                continue
 
-    logger.info(response)
-    return response
+            try:
+                spool_keys.append(resilience.call(spool.flush, bucket))
+            except ARCHIVE_ERRORS as e:  # retry the batch from the spool's first record
+                logger.exception(e)
+                return failed_archive_response(bucket, spool.key, spool_keys,
+                                               group[position - len(spool.entries)])
+
+    if invalid_record is not None:
+        return invalid_event_response(invalid_record)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f"Successfully archived to s3://{bucket.name}",
+            'records': spool_keys
+        }),
+        'batchItemFailures': []
+    }
+
+
+def parquet_records(bucket: 'boto3.resources.factory.s3.Bucket', records: List[Dict[str, Any]],
+                    record_keys: List[str]) -> Dict[str, Any]:
+    """Archive DynamoDB stream records as Parquet files partitioned by removal date
+
+    Consecutive records removed on the same day are written to the file
+    'parquet/{table}/removal_date={date}/{first}_{last}.parquet', where first and
+    last are the sequence numbers of its first and last records, so retries
+    overwrite the same file. Each attribute of the typed OldImages is written to
+    a column registered for its name and type in the write-once column registry
+    (see SchemaRegistry), whose columns never change type, so all files of a
+    table can be queried together. The environment variable
+    'ARCHIVE_PARQUET_COMPRESSION' selects the compression codec.
+
+    If a file fails to upload or its records cannot be converted to Parquet,
+    its first record is reported in 'batchItemFailures'. The retried records
+    are then archived as JSON again, which overwrites their objects or, for
+    spools, leaves duplicates which compaction drops.
+
+    Each file holds the records of one batch, so the event source mapping's
+    batch size and batching window should be large to avoid many small files.
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param records: DynamoDB stream records
+    :type records: list
+    :param record_keys: keys of the JSON objects the records have been archived to
+    :type record_keys: list
+
+    :raises KeyError: environment variable 'ARCHIVE_SCHEMA_TABLE' is not defined
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    registry = get_schema_registry()
+    compression = os.environ.get('ARCHIVE_PARQUET_COMPRESSION', PARQUET_COMPRESSION)
+    invalid_record = next((record for record in records if record['eventName'] != 'REMOVE'), None)
+    valid_records = records if invalid_record is None else records[:records.index(invalid_record)]
+
+    record_keys = list(record_keys)
+    for date, group in itertools.groupby(valid_records, key=removal_date):
+        group = list(group)
+        archived_table = table_name(group[0])
+        sequence_numbers = [record['dynamodb']['SequenceNumber'] for record in group]
+        record_key = (f'{PARQUET_PREFIX}/{archived_table}/removal_date={date}/'
+                      f'{sequence_numbers[0]}_{sequence_numbers[-1]}.parquet')
+        try:
+            rows = [registry.row(archived_table, record['dynamodb']['OldImage']) for record in group]
+            schema = registry.schema(archived_table)
+            columns = {name: schema[name] for row in rows for name in row}
+            body = write_parquet(rows, sequence_numbers, columns, compression)
+            resilience.call(bucket.put_object, Key=record_key, Body=body)
+        except ARCHIVE_ERRORS + CONVERSION_ERRORS as e:  # retry the batch from the file's first record
+            logger.exception(e)
+            return failed_archive_response(bucket, record_key, record_keys, group[0])
+        record_keys.append(record_key)
+
+    if invalid_record is not None:
+        return invalid_event_response(invalid_record)
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'message': f"Successfully archived to s3://{bucket.name}",
+            'records': record_keys
+        }),
+        'batchItemFailures': []
+    }
+
+
+def get_schema_registry() -> SchemaRegistry:
+    """Get the registry of the Parquet archives' columns
+
+    The environment variable 'ARCHIVE_SCHEMA_TABLE' specifies its DynamoDB table.
+
+    :raises KeyError: environment variable 'ARCHIVE_SCHEMA_TABLE' is not defined
+
+    :return: column registry
+    :rtype: SchemaRegistry
+    """
+    global schema_registry
+    if schema_registry is None:
+        schema_table = os.environ.get('ARCHIVE_SCHEMA_TABLE')
+        if schema_table is None:
+            raise KeyError("Missing required environmental variable 'ARCHIVE_SCHEMA_TABLE'")
+        schema_registry = SchemaRegistry(dynamodb.Table(schema_table), resilience)
+    return schema_registry
+
+
+def invalid_event_response(record: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the response to a DynamoDB stream record which is not a 'REMOVE' event
+
+    :param record: DynamoDB stream record
+    :type record: dict
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    return {
+        'statusCode': 500,
+        'body': json.dumps({
+            'message': f"Invalid DynamoDB streams event passed ({record['eventName']})"
+        })
+    }
+
+
+def failed_archive_response(bucket: 'boto3.resources.factory.s3.Bucket', key: str,
+                            record_keys: List[str], record: Dict[str, Any]) -> Dict[str, Any]:
+    """Build the response to a failed upload, retrying the batch from a given record
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param key: S3 object key which failed to upload
+    :type key: str
+    :param record_keys: keys of the objects archived before the failure
+    :type record_keys: list
+    :param record: first DynamoDB stream record which is not archived
+    :type record: dict
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    return {
+        'statusCode': 500,
+        'body': json.dumps({
+            'message': f"Failed to archive {key} to s3://{bucket.name}",
+            'records': record_keys
+        }),
+        'batchItemFailures': [{'itemIdentifier': record['dynamodb']['SequenceNumber']}]
+    }
+
+
+def archive_key(record: Dict[str, Any]) -> str:
+    """Build the deterministic S3 object key of an archived DynamoDB stream record
+
+    The key has the form '{table}/{date}/{id}_{sequence number}.json', where the
+    date is the UTC day of the record's 'ApproximateCreationDateTime', i.e. the
+    day the item was removed. Every delivery of the same stream record yields
+    the same key.
+
+    :param record: DynamoDB stream record
+    :type record: dict
+
+    :return: S3 object key
+    :rtype: str
+    """
+    record_id = list(record['dynamodb']['OldImage']['id'].values())[0]
+    sequence_number = record['dynamodb']['SequenceNumber']
+    return f'{table_name(record)}/{removal_date(record)}/{record_id}_{sequence_number}.json'
+
+
+def table_name(record: Dict[str, Any]) -> str:
+    """Get the name of the DynamoDB table a stream record originates from
+
+    :param record: DynamoDB stream record
+    :type record: dict
+
+    :return: DynamoDB table name
+    :rtype: str
+    """
+    return record['eventSourceARN'].split(':table/')[1].split('/')[0]
+
+
+def removal_date(record: Dict[str, Any]) -> str:
+    """Get the UTC day of a stream record's 'ApproximateCreationDateTime'
+
+    :param record: DynamoDB stream record
+    :type record: dict
+
+    :return: day (YYYY-MM-DD)
+    :rtype: str
+    """
+    removal_time = datetime.fromtimestamp(record['dynamodb']['ApproximateCreationDateTime'], tz=timezone.utc)
+    return removal_time.strftime('%Y-%m-%d')
+
+
+def object_exists(bucket: 'boto3.resources.factory.s3.Bucket', key: str) -> bool:
+    """Check whether an object exists in an S3 bucket
+
+    :param bucket: boto3 S3 bucket instance
+    :type bucket: boto3.resources.factory.s3.Bucket
+    :param key: S3 object key
+    :type key: str
+
+    :raises botocore.exceptions.ClientError: boto3 client error other than a missing object
+    :raises ServiceUnavailableError: S3 is throttling or unavailable
+
+    :return: True if the object exists
+    :rtype: bool
+    """
+    try:
+        resilience.call(bucket.Object(key).load)
+    except botocore.exceptions.ClientError as e:
+        if e.response['Error']['Code'] in ('404', 'NoSuchKey', 'NotFound'):
+            return False
+        raise
+    return True
+
+
+def remember_archived_key(key: str) -> None:
+    """Record an archived object key in the container's bounded key cache
+
+    :param key: S3 object key
+    :type key: str
+    """
+    archived_keys[key] = None
+    archived_keys.move_to_end(key)
+    while len(archived_keys) > ARCHIVED_KEYS_CACHE_SIZE:
+        archived_keys.popitem(last=False)
@@ -0,0 +1,276 @@
+import json
+import base64
+from decimal import Decimal
+from typing import Dict, Any, List, Optional
+
+import botocore.exceptions
+from boto3.dynamodb.conditions import Attr, Key
+from boto3.dynamodb.types import TypeDeserializer, Binary
+
+# Errors of images which cannot be converted to Parquet rows; pyarrow is only
+# imported when a file is written (see write_parquet), so its errors are re-raised
+# as ValueError
+CONVERSION_ERRORS = (ValueError, TypeError, OverflowError)
+
+
+# Column types of DynamoDB attribute types; maps and lists are stored as JSON
+# strings. Numbers of up to 38 digits do not fit into any integer type, so they
+# are always stored as doubles
+ATTRIBUTE_TYPES = {
+    'S': 'string',
+    'N': 'double',
+    'BOOL': 'bool',
+    'B': 'binary',
+    'SS': 'string_set',
+    'NS': 'number_set',
+    'BS': 'binary_set',
+    'M': 'json',
+    'L': 'json'
+}
+
+deserializer = TypeDeserializer()
+
+
+class SchemaRegistry:
+    """Write-once registry of the columns of the tables' Parquet archives
+
+    Each column is a DynamoDB item of the schema table, keyed by the archived
+    'table_name' and the 'column_name', holding the 'column_type'. Columns are
+    registered with a conditional put, so the first type registered for a name
+    wins, even across concurrent invocations, and a column's type never changes.
+    Files written at any time therefore agree on the type of every column.
+    Registered columns are cached per container, as they are immutable.
+
+    :param table: boto3 DynamoDB table instance of the schema table
+    :type table: boto3.resources.factory.dynamodb.Table
+    :param resilience: resilience policy the requests are made through
+    :type resilience: Resilience
+    """
+
+    def __init__(self, table: 'boto3.resources.factory.dynamodb.Table', resilience: 'Resilience') -> None:
+        self.table = table
+        self.resilience = resilience
+        self.schemas: Dict[str, Dict[str, str]] = {}
+
+    def schema(self, table_name: str) -> Dict[str, str]:
+        """Get the registered columns of a table
+
+        :param table_name: archived DynamoDB table name
+        :type table_name: str
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+
+        :return: column types by column name
+        :rtype: dict
+        """
+        if table_name not in self.schemas:
+            schema = {}
+            query = {'KeyConditionExpression': Key('table_name').eq(table_name), 'ConsistentRead': True}
+            while True:
+                response = self.resilience.call(self.table.query, **query)
+                schema.update((item['column_name'], item['column_type']) for item in response['Items'])
+                if 'LastEvaluatedKey' not in response:
+                    break
+                query['ExclusiveStartKey'] = response['LastEvaluatedKey']
+            self.schemas[table_name] = schema
+        return self.schemas[table_name]
+
+    def column(self, table_name: str, name: str, column_type: str) -> str:
+        """Get the column holding an attribute's values of a column type, registering it if new
+
+        An attribute's values are held in the column of the same name if they
+        have the type registered for it. Values of any other type are held in
+        the column '{name}__{type}', e.g. 'price__string'.
+
+        :param table_name: archived DynamoDB table name
+        :type table_name: str
+        :param name: attribute name
+        :type name: str
+        :param column_type: column type of the attribute's value
+        :type column_type: str
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+
+        :return: column name
+        :rtype: str
+        """
+        schema = self.schema(table_name)
+        while True:
+            if name not in schema:
+                self.register(table_name, name, column_type)
+            if schema[name] == column_type:
+                return name
+            name = f'{name}__{column_type}'
+
+    def register(self, table_name: str, name: str, column_type: str) -> None:
+        """Register a new column, or cache the column another invocation registered first
+
+        :param table_name: archived DynamoDB table name
+        :type table_name: str
+        :param name: column name
+        :type name: str
+        :param column_type: column type
+        :type column_type: str
+
+        :raises botocore.exceptions.ClientError: boto3 client error when registering the column
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+        """
+        try:
+            self.resilience.call(self.table.put_item,
+                                 Item={'table_name': table_name, 'column_name': name, 'column_type': column_type},
+                                 ConditionExpression=Attr('column_name').not_exists())
+        except botocore.exceptions.ClientError as e:
+            if e.response['Error']['Code'] != 'ConditionalCheckFailedException':
+                raise
+            item = self.resilience.call(self.table.get_item, Key={'table_name': table_name, 'column_name': name},
+                                        ConsistentRead=True)['Item']
+            column_type = item['column_type']
+        self.schemas[table_name][name] = column_type
+
+    def row(self, table_name: str, image: Dict[str, Any]) -> Dict[str, Dict[str, Any]]:
+        """Assign the attributes of a typed DynamoDB image to their columns
+
+        NULL attributes are left out, as they fit any column.
+
+        :param table_name: archived DynamoDB table name
+        :type table_name: str
+        :param image: typed DynamoDB image
+        :type image: dict
+
+        :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+
+        :return: typed attribute values by column name
+        :rtype: dict
+        """
+        return {self.column(table_name, name, attribute_type(value)): value
+                for name, value in image.items() if attribute_type(value) is not None}
+
+
+def attribute_type(value: Dict[str, Any]) -> Optional[str]:
+    """Get the column type of a typed DynamoDB attribute value
+
+    :param value: typed DynamoDB attribute value, e.g. {'S': 'text'}
+    :type value: dict
+
+    :return: column type or None for NULL values
+    :rtype: str
+    """
+    return ATTRIBUTE_TYPES.get(next(iter(value.keys())))
+
+
+def arrow_type(column_type: str) -> 'pyarrow.DataType':
+    """Get the Arrow data type of a column type
+
+    :param column_type: column type
+    :type column_type: str
+
+    :return: Arrow data type
+    :rtype: pyarrow.DataType
+    """
+    import pyarrow
+
+    return {
+        'string': pyarrow.string(),
+        'double': pyarrow.float64(),
+        'bool': pyarrow.bool_(),
+        'binary': pyarrow.binary(),
+        'string_set': pyarrow.list_(pyarrow.string()),
+        'number_set': pyarrow.list_(pyarrow.float64()),
+        'binary_set': pyarrow.list_(pyarrow.binary()),
+        'json': pyarrow.string()
+    }[column_type]
+
+
+def convert_value(value: Dict[str, Any], column_type: str) -> Any:
+    """Convert a typed DynamoDB attribute value to a value of a column type
+
+    :param value: typed DynamoDB attribute value
+    :type value: dict
+    :param column_type: column type
+    :type column_type: str
+
+    :return: column value
+    :rtype: Any
+    """
+    if column_type == 'json':
+        return json.dumps(value_to_json(deserializer.deserialize(value)))
+
+    python_value = deserializer.deserialize(value)
+    if column_type == 'double':
+        return float(python_value)
+    if column_type == 'binary':
+        return bytes(python_value)
+    if column_type == 'number_set':
+        return sorted(float(number) for number in python_value)
+    if column_type == 'binary_set':
+        return sorted(bytes(binary) for binary in python_value)
+    if column_type == 'string_set':
+        return sorted(python_value)
+    return python_value
+
+
+def value_to_json(value: Any) -> Any:
+    """Convert a deserialized DynamoDB value to a JSON serializable value
+
+    :param value: deserialized DynamoDB value
+    :type value: Any
+
+    :return: JSON serializable value
+    :rtype: Any
+    """
+    if isinstance(value, Decimal):
+        return int(value) if value == value.to_integral_value() else float(value)
+    if isinstance(value, Binary):
+        return base64.b64encode(bytes(value)).decode('ascii')
+    if isinstance(value, dict):
+        return {key: value_to_json(item) for key, item in value.items()}
+    if isinstance(value, (list, set)):
+        return [value_to_json(item) for item in value]
+    return value
+
+
+def write_parquet(rows: List[Dict[str, Dict[str, Any]]], sequence_numbers: List[str], columns: Dict[str, str],
+                  compression: str) -> bytes:
+    """Write rows of typed DynamoDB attribute values to a Parquet file
+
+    Rows lacking a column hold nulls. Each row also holds its stream record's
+    '_sequence_number'. Only the given columns are written, so readers must map
+    columns by name, as Athena does for Parquet by default.
+
+    :param rows: typed attribute values by column name (see SchemaRegistry.row)
+    :type rows: list
+    :param sequence_numbers: stream sequence numbers of the rows
+    :type sequence_numbers: list
+    :param columns: column types by column name
+    :type columns: dict
+    :param compression: Parquet compression codec, e.g. 'snappy'
+    :type compression: str
+
+    :raises ImportError: pyarrow is not installed
+    :raises ValueError: the rows cannot be converted to Parquet
+
+    :return: Parquet file content
+    :rtype: bytes
+    """
+    try:  # imported on first use, so invocations which do not write Parquet do not pay for it
+        import pyarrow
+        import pyarrow.parquet
+    except ImportError:
+        raise ImportError("The parquet archive format requires the 'pyarrow' package") from None
+
+    names = sorted(columns.keys())
+    arrow_schema = pyarrow.schema(
+        [pyarrow.field(name, arrow_type(columns[name])) for name in names]
+        + [pyarrow.field('_sequence_number', pyarrow.string())]
+    )
+    data = {name: [convert_value(row[name], columns[name]) if name in row else None for row in rows]
+            for name in names}
+    data['_sequence_number'] = sequence_numbers
+
+    sink = pyarrow.BufferOutputStream()
+    try:
+        pyarrow.parquet.write_table(pyarrow.Table.from_pydict(data, schema=arrow_schema), sink,
+                                    compression=compression)
+    except pyarrow.ArrowException as e:
+        raise ValueError(f'Failed to write Parquet file: {e}') from e
+    return sink.getvalue().to_pybytes()
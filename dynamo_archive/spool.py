@@ -0,0 +1,63 @@
+import gzip
+import json
+import posixpath
+from typing import Dict, Any, List
+
+
+class ArchiveSpool:
+    """In-memory spool of DynamoDB stream records removed on the same day
+
+    Flushing uploads all spooled records as a single gzip-compressed JSON Lines
+    object and empties the spool. Records are not written ahead to the
+    container's /tmp: the stream redelivers every record which is not
+    acknowledged, so a failed or interrupted upload loses nothing.
+    """
+
+    def __init__(self) -> None:
+        self.entries: List[Dict[str, Any]] = []
+        self.size = 0
+
+    @property
+    def key(self) -> str:
+        """S3 object key of the spooled entries
+
+        The key has the form '{prefix}/spool_{first}_{last}.jsonl.gz', where the
+        prefix is that of the entries' archive keys and first and last are the
+        sequence numbers of the first and last spooled records. Uploading the
+        same records again therefore overwrites the same object.
+        """
+        prefix = posixpath.dirname(self.entries[0]['key'])
+        return f"{prefix}/spool_{self.entries[0]['sequence']}_{self.entries[-1]['sequence']}.jsonl.gz"
+
+    def append(self, entry: Dict[str, Any]) -> None:
+        """Append an entry to the spool
+
+        :param entry: spool entry with the record's 'key', 'sequence' and 'image'
+        :type entry: dict
+
+        :raises ValueError: entry belongs to another day than the spooled entries
+        """
+        if self.entries and posixpath.dirname(entry['key']) != posixpath.dirname(self.entries[0]['key']):
+            raise ValueError(f"Spool entry {entry['key']} belongs to another day than {self.key}")
+        self.entries.append(entry)
+        self.size += len(json.dumps(entry)) + 1
+
+    def flush(self, bucket: 'boto3.resources.factory.s3.Bucket') -> str:
+        """Upload the spooled entries as one compressed object and empty the spool
+
+        The spool is only emptied after a successful upload.
+
+        :param bucket: boto3 S3 bucket instance
+        :type bucket: boto3.resources.factory.s3.Bucket
+
+        :raises botocore.exceptions.ClientError: boto3 client error when uploading the spool
+
+        :return: S3 object key of the uploaded spool
+        :rtype: str
+        """
+        key = self.key
+        body = gzip.compress(''.join(json.dumps(entry) + '\n' for entry in self.entries).encode('utf-8'))
+        bucket.put_object(Key=key, Body=body)
+        self.entries = []
+        self.size = 0
+        return key
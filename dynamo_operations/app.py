@@ -1,28 +1,65 @@
 import os
-from decimal import Decimal
-from datetime import datetime
-from typing import Dict, Any
+import gzip
+import zlib
+import uuid
+import base64
+import hashlib
+from typing import Dict, Any, Optional, Callable, Union, List, Set
 
 import simplejson as json
 import boto3
 import botocore.exceptions
 
 try:  # when Lambda handler is __main__
-    from definitions import REGION_TIMEZONES, EXPIRY_DELTA
+    from definitions import VERSION_ATTRIBUTE, READ_CACHE_CONTROL, COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE
+    from queues import SqsQueue, LocalQueue
 except ImportError:  # when Lambda handler is imported in another file
-    from .definitions import REGION_TIMEZONES, EXPIRY_DELTA
+    from .definitions import VERSION_ATTRIBUTE, READ_CACHE_CONTROL, COMPRESSION_LEVEL, COMPRESSION_MIN_SIZE
+    from .queues import SqsQueue, LocalQueue
+
+try:  # when the common Lambda layer is installed
+    from batching import BatchWriter, MAX_UNPROCESSED_RETRIES, backoff_unprocessed
+    from expiry import expiration_time
+    from resilience import Resilience, ServiceUnavailableError
+except ImportError:  # when Lambda handler is imported in another file
+    from common.batching import BatchWriter, MAX_UNPROCESSED_RETRIES, backoff_unprocessed
+    from common.expiry import expiration_time
+    from common.resilience import Resilience, ServiceUnavailableError
+
+
+# Supported response content encodings, in order of preference
+CONTENT_ENCODERS: Dict[str, Callable[[bytes, int], bytes]] = {
+    'gzip': lambda data, level: gzip.compress(data, compresslevel=level),
+    'deflate': lambda data, level: zlib.compress(data, level)
+}
+
+BATCH_GET_SIZE = 100  # maximum number of keys per BatchGetItem request
+
+# DynamoDB calls are retried, rate limited and circuit broken per container
+resilience = Resilience('dynamo_operations')
+# Created once per container, so botocore's adaptive rate limiter persists across invocations
+dynamodb = boto3.resource('dynamodb', config=resilience.client_config())
+
+# Queue of asynchronous write operations, connected on first use (see get_write_queue)
+write_queue: Optional[Union[SqsQueue, LocalQueue]] = None
 
 
 def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str, Any]:
     """AWS Lambda function to interact with a DynamoDB table
 
-    The following DynamoDB operations are supported: READ, INSERT, DELETE.
+    The following DynamoDB operations are supported: READ, INSERT, DELETE, BULK.
     The operation type must be specified in the Lambda event's body. If
     an invalid operation is parsed, a 400 Bad Request response is returned.
 
     An HTTP status response is always returned with the appropriate item
     details. The HTTP response's details are formed by the appropriate
-    operation processing function.
+    operation processing function. The response body is compressed when
+    the client's 'Accept-Encoding' header allows it (see compress_response).
+
+    DynamoDB calls are made through the container's resilience policy. If
+    DynamoDB keeps throttling or failing, or the policy's circuit breaker is
+    open, a 503 Service Unavailable response with a 'Retry-After' header is
+    returned.
 
     :param event: deserialized Lambda function event
     :type event: dict
@@ -37,27 +74,45 @@ def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str,
     operations = {
         'read': read_from_db,
         'insert': insert_into_db,
-        'delete': delete_from_db
+        'delete': delete_from_db,
+        'bulk': bulk_write_db
     }
 
+    # API Gateway base64-encodes request bodies of binary media types
+    if event.get('isBase64Encoded') and event.get('body') is not None:
+        event = {**event, 'body': base64.b64decode(event['body']).decode('utf-8'), 'isBase64Encoded': False}
+
     # Determine operation to handle
     operation = 'read' if event['httpMethod'] == 'GET' else json.loads(event['body'])['operation']
     if operation not in operations.keys():
-        return {
+        return compress_response({
             'statusCode': 400,
             'body': json.dumps({
                 'message': f"Invalid DynamoDB operation specified; Valid operations: {list(operations.keys())}"
             }),
-        }
+        }, event)
 
     # Connect to the test DynamoDB table
     table_name = os.environ.get('TABLE_NAME')
-    dynamodb = boto3.resource('dynamodb')
     table = dynamodb.Table(table_name)
 
     # Insert the item into the database table
-    response = operations[operation](table, event)
-    return response
+    resilience.bind(context)
+    try:
+        response = operations[operation](table, event)
+    except ServiceUnavailableError as e:
+        response = {
+            'statusCode': 503,
+            'headers': {
+                'Retry-After': str(e.retry_after)
+            },
+            'body': json.dumps({
+                'message': str(e)
+            }),
+        }
+    finally:
+        resilience.metrics.flush()
+    return compress_response(response, event)
 
 
 def read_from_db(table: 'boto3.resources.factory.dynamodb.Table',
@@ -71,16 +126,25 @@ def read_from_db(table: 'boto3.resources.factory.dynamodb.Table',
     code 200. If the item is not found in the table, a 404 Not Found status
     is returned.
 
+    Found items are returned with an 'ETag' header, taken from the item's
+    reserved '_etag' attribute (or computed from the item's content for items written
+    without one) and a short 'Cache-Control' header. If the request's
+    'If-None-Match' header matches the item's ETag, a bodyless 304 Not Modified
+    response is returned instead. The '_etag' attribute is left out of the
+    returned item.
+
     :param table: boto3 DynamoDB table instance
     :type: boto3.resources.factory.dynamodb.Table
     :param event: deserialized API Gateway event
     :type: dict
 
+    :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+
     :return: HTTP response with retrieved item
     :rtype: dict
     """
     item_pk = event['queryStringParameters']['id']
-    table_response = table.get_item(Key={'id': item_pk})
+    table_response = resilience.call(table.get_item, Key={'id': item_pk})
     if 'Item' not in table_response.keys():  # return not found response
         return {
             'statusCode': 404,
@@ -90,11 +154,25 @@ def read_from_db(table: 'boto3.resources.factory.dynamodb.Table',
             }),
         }
 
+    item = table_response['Item']
+    etag = f'"{item.pop(VERSION_ATTRIBUTE, None) or compute_version(item)}"'
+    headers = {
+        'ETag': etag,
+        'Cache-Control': READ_CACHE_CONTROL
+    }
+    if etag_matches(etag, get_header(event, 'If-None-Match')):  # client copy is up to date
+        return {
+            'statusCode': 304,
+            'headers': headers,
+            'body': '',
+        }
+
     return {
         'statusCode': 200,
+        'headers': headers,
         'body': json.dumps({
             'table': table.table_name,
-            'item': table_response['Item']
+            'item': item
         }, use_decimal=True),
     }
 
@@ -106,28 +184,32 @@ def insert_into_db(table: 'boto3.resources.factory.dynamodb.Table',
     Before the item is inserted, an additional field named 'expiration_time'
     is created and set to the AWS region's current time + a constant time delta.
     This field's value is a saved as a UNIX epoch timestamp and used by DynamoDB
-    TTL to expire records.
+    TTL to expire records. The item's content version is then stored in the
+    reserved '_etag' field and later served as the item's ETag by read operations.
 
     If the item with the specified primary key already exists, the former
     is overridden. In any case a 200 Success HTTP status is returned.
 
+    If the event's body sets 'async', the prepared item is instead queued
+    for the drain function to write (see enqueue_write) and a 202 Accepted
+    response is returned.
+
     :param table: boto3 DynamoDB table instance
     :type: boto3.resources.factory.dynamodb.Table
     :param event: deserialized API Gateway event
     :type: dict
 
     :raises KeyError: environment variable 'AWS_REGION' is not defined
+    :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
 
     :return: HTTP success response
     :rtype: dict
     """
-    payload = json.loads(event['body'], use_decimal=True)['payload']['Item']
-    region = os.environ.get('AWS_REGION')
-    region_tz = REGION_TIMEZONES[region]
-    expiration_time = (datetime.now(region_tz) + EXPIRY_DELTA).timestamp()
-    payload['expiration_time'] = Decimal(expiration_time)
+    payload = prepare_item(json.loads(event['body'], use_decimal=True)['payload']['Item'])
+    if json.loads(event['body']).get('async'):
+        return enqueue_write(table, event, 'insert', {'Item': payload}, payload['id'])
 
-    table.put_item(Item=payload)
+    resilience.call(table.put_item, Item=payload)
     return {
         'statusCode': 200,
         'body': json.dumps({
@@ -148,19 +230,27 @@ def delete_from_db(table: 'boto3.resources.factory.dynamodb.Table',
     primary key value. If the item does not exist in the table, a 404 Not Found
     response is returned.
 
+    If the event's body sets 'async', the deletion is instead queued for the
+    drain function to apply (see enqueue_write) and a 202 Accepted response
+    is returned without checking whether the item exists.
+
     :param table: boto3 DynamoDB table instance
     :type: boto3.resources.factory.dynamodb.Table
     :param event: deserialized API Gateway event
     :type: dict
 
     :raises botocore.exceptions.ClientError: boto3 client error when attempting to delete item
+    :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
 
     :return: HTTP status response with deleted item primary key
     :rtype: dict
     """
     payload = json.loads(event['body'])['payload']['Key']
+    if json.loads(event['body']).get('async'):
+        return enqueue_write(table, event, 'delete', {'Key': payload}, payload['id'])
+
     try:
-        table.delete_item(Key=payload, ConditionExpression='attribute_exists(id)')
+        resilience.call(table.delete_item, Key=payload, ConditionExpression='attribute_exists(id)')
     except botocore.exceptions.ClientError as e:
         if e.response['Error']['Code'] == 'ConditionalCheckFailedException':
             return {
@@ -170,8 +260,7 @@ def delete_from_db(table: 'boto3.resources.factory.dynamodb.Table',
                     'item': None
                 }),
             }
-        else:
-            raise e
+        raise
     else:
         return {
             'statusCode': 200,
@@ -182,3 +271,373 @@ def delete_from_db(table: 'boto3.resources.factory.dynamodb.Table',
                 }
             }),
         }
+
+
+def bulk_write_db(table: 'boto3.resources.factory.dynamodb.Table',
+                  event: Dict[str, Any]) -> Dict[str, Any]:
+    """Apply an ordered list of insert and delete operations to the DynamoDB table
+
+    The event body's payload holds a list of 'Operations', each shaped like
+    the body of a single insert or delete request. Operations are collapsed per
+    primary key, the last one winning, and only the resulting writes are applied
+    with BatchWriteItem (see BatchWriter). A delete of an item which neither
+    existed before the request nor was inserted by it is not written at all.
+
+    The response holds one result per operation, in order, with the status code
+    the operation would have received on its own: 200 for inserts and for
+    deletes of existing items and 404 for deletes of missing items. Whether an
+    item existed before the request is read with BatchGetItem for keys whose
+    first operation is a delete. If any operation is invalid, a 400 Bad Request
+    response is returned and nothing is written.
+
+    Writes are not transactional: if DynamoDB becomes unavailable part-way
+    through the batch writes, the 503 response is returned although some of
+    the operations may already have been applied. Retrying the request leads
+    to the same final table state, though its per operation results may differ.
+
+    :param table: boto3 DynamoDB table instance
+    :type: boto3.resources.factory.dynamodb.Table
+    :param event: deserialized API Gateway event
+    :type: dict
+
+    :raises KeyError: environment variable 'AWS_REGION' is not defined
+    :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+
+    :return: HTTP status response with per operation results
+    :rtype: dict
+    """
+    operations = json.loads(event['body'], use_decimal=True)['payload']['Operations']
+    invalid_operations = [operation.get('operation') for operation in operations
+                          if operation.get('operation') not in ('insert', 'delete')]
+    if invalid_operations:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'message': f"Invalid bulk operations specified ({invalid_operations}); "
+                           f"Valid operations: ['insert', 'delete']"
+            }),
+        }
+
+    # Look up whether items deleted before being inserted exist
+    first_operations = {}
+    for operation in operations:
+        item_pk = operation['payload']['Item' if operation['operation'] == 'insert' else 'Key']['id']
+        first_operations.setdefault(item_pk, operation['operation'])
+    lookup_pks = [item_pk for item_pk, operation in first_operations.items() if operation == 'delete']
+    existing_pks = find_existing_items(dynamodb, table.table_name, lookup_pks)
+
+    # Replay the operations to determine their results and the final write of each key
+    exists = {item_pk: item_pk in existing_pks for item_pk in lookup_pks}
+    results = []
+    final_writes = {}
+    for operation in operations:
+        if operation['operation'] == 'insert':
+            item = prepare_item(operation['payload']['Item'])
+            exists[item['id']] = True
+            final_writes[item['id']] = {'PutRequest': {'Item': item}}
+            results.append({'statusCode': 200, 'item': {'id': item['id']}})
+            continue
+
+        key = operation['payload']['Key']
+        if exists.get(key['id'], True):
+            results.append({'statusCode': 200, 'item': {'id': key['id']}})
+        else:
+            results.append({'statusCode': 404, 'item': None})
+        exists[key['id']] = False
+        if first_operations[key['id']] == 'delete' and key['id'] not in existing_pks:  # the item never existed
+            final_writes[key['id']] = None
+        else:
+            final_writes[key['id']] = {'DeleteRequest': {'Key': key}}
+
+    writer = BatchWriter(dynamodb, table.table_name, resilience)
+    for item_pk, request in final_writes.items():
+        if request is not None:
+            writer.buffer(item_pk, request)
+    writer.flush()
+
+    return {
+        'statusCode': 200,
+        'body': json.dumps({
+            'table': table.table_name,
+            'results': results,
+            'writes': writer.written
+        }),
+    }
+
+
+def find_existing_items(dynamodb: 'boto3.resources.factory.dynamodb.ServiceResource', table_name: str,
+                        item_pks: List[str]) -> Set[str]:
+    """Find which of the given primary keys have items in the DynamoDB table
+
+    Keys are looked up with BatchGetItem in batches of 100, projecting only
+    the primary key. Keys left unprocessed by DynamoDB are looked up again with
+    exponential backoff, like BatchWriter's unprocessed writes.
+
+    :param dynamodb: boto3 DynamoDB service resource
+    :type dynamodb: boto3.resources.factory.dynamodb.ServiceResource
+    :param table_name: DynamoDB table name
+    :type table_name: str
+    :param item_pks: primary key values
+    :type item_pks: list
+
+    :raises ServiceUnavailableError: DynamoDB is throttling or unavailable
+
+    :return: primary key values of the existing items
+    :rtype: set
+    """
+    existing_pks = set()
+    for start in range(0, len(item_pks), BATCH_GET_SIZE):
+        request = {table_name: {
+            'Keys': [{'id': item_pk} for item_pk in item_pks[start:start + BATCH_GET_SIZE]],
+            'ProjectionExpression': 'id'
+        }}
+        for attempt in range(1, MAX_UNPROCESSED_RETRIES + 1):
+            response = resilience.call(dynamodb.batch_get_item, RequestItems=request)
+            existing_pks.update(item['id'] for item in response['Responses'].get(table_name, []))
+            request = response.get('UnprocessedKeys')
+            if not request:
+                break
+            backoff_unprocessed(resilience, attempt)
+        else:
+            unprocessed = len(request[table_name]['Keys'])
+            raise ServiceUnavailableError(f'{unprocessed} read requests left unprocessed by DynamoDB', 1)
+    return existing_pks
+
+
+def prepare_item(item: Dict[str, Any]) -> Dict[str, Any]:
+    """Prepare an item for insertion into the DynamoDB table
+
+    The item's 'expiration_time' is set to the AWS region's current time + a
+    constant time delta and its content version is stored in the reserved '_etag'
+    field, replacing any '_etag' sent by the client.
+
+    :param item: DynamoDB item from a request's payload
+    :type item: dict
+
+    :raises KeyError: environment variable 'AWS_REGION' is not defined
+
+    :return: the prepared item
+    :rtype: dict
+    """
+    item['expiration_time'] = expiration_time(os.environ.get('AWS_REGION'))
+    item[VERSION_ATTRIBUTE] = compute_version(item)
+    return item
+
+
+def enqueue_write(table: 'boto3.resources.factory.dynamodb.Table', event: Dict[str, Any],
+                  operation: str, payload: Dict[str, Any], item_pk: str) -> Dict[str, Any]:
+    """Queue a write operation for the drain function and accept the request
+
+    The queued message holds the operation, its payload and the request id,
+    which is the API Gateway request id when available. Messages are grouped
+    by the SHA-256 digest of the item's primary key, so writes of the same item
+    are applied in order; SQS only accepts group ids of up to 128 characters
+    from a restricted set, which a raw key may exceed.
+    Writes whose primary key is not a string are never queued, as DynamoDB
+    would always reject them, and neither are writes to a function without a
+    queue (see get_write_queue); a 400 Bad Request response is returned instead.
+
+    :param table: boto3 DynamoDB table instance
+    :type: boto3.resources.factory.dynamodb.Table
+    :param event: deserialized API Gateway event
+    :type: dict
+    :param operation: queued operation, 'insert' or 'delete'
+    :type operation: str
+    :param payload: operation payload with the 'Item' to insert or the 'Key' to delete
+    :type payload: dict
+    :param item_pk: primary key value of the written item
+    :type item_pk: str
+
+    :raises ServiceUnavailableError: SQS is throttling or unavailable
+
+    :return: HTTP accepted response with the request id
+    :rtype: dict
+    """
+    if not isinstance(item_pk, str):
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'message': f"Invalid primary key ({item_pk!r}); the 'id' must be a string"
+            }),
+        }
+
+    queue = get_write_queue()
+    if queue is None:
+        return {
+            'statusCode': 400,
+            'body': json.dumps({
+                'message': "Asynchronous writes are not enabled; 'QUEUE_URL' is not configured"
+            }),
+        }
+
+    request_id = event.get('requestContext', {}).get('requestId') or str(uuid.uuid4())
+    body = json.dumps({
+        'request_id': request_id,
+        'operation': operation,
+        'payload': payload
+    }, use_decimal=True)
+    group_id = hashlib.sha256(item_pk.encode('utf-8')).hexdigest()
+    resilience.call(queue.send, body, group_id, request_id)
+    return {
+        'statusCode': 202,
+        'body': json.dumps({
+            'table': table.table_name,
+            'item': {
+                'id': item_pk
+            },
+            'request_id': request_id
+        }),
+    }
+
+
+def get_write_queue() -> Optional[Union[SqsQueue, LocalQueue]]:
+    """Get the queue of asynchronous write operations
+
+    The environment variable 'QUEUE_URL' specifies the SQS queue. Without it,
+    asynchronous writes are disabled; writes are never accepted into a queue
+    which would lose them.
+
+    :return: write operation queue or None if no queue is configured
+    :rtype: SqsQueue or LocalQueue
+    """
+    global write_queue
+    if write_queue is None and os.environ.get('QUEUE_URL'):
+        write_queue = SqsQueue(os.environ['QUEUE_URL'], boto3.client('sqs', config=resilience.client_config()))
+    return write_queue
+
+
+def get_header(event: Dict[str, Any], name: str) -> Optional[str]:
+    """Get an HTTP request header's value from an API Gateway event
+
+    Header names are matched case-insensitively. API Gateway passes 'null'
+    headers when the request carries none, which is treated as missing.
+
+    :param event: deserialized API Gateway event
+    :type event: dict
+    :param name: HTTP header name
+    :type name: str
+
+    :return: header value or None if the header is missing
+    :rtype: str
+    """
+    headers = event.get('headers') or {}
+    for header, value in headers.items():
+        if header.lower() == name.lower():
+            return value
+    return None
+
+
+def compute_version(item: Dict[str, Any]) -> str:
+    """Compute a stable content version of a DynamoDB item
+
+    The item is serialized with sorted keys, so attribute order does not
+    affect the result. The version attribute itself is excluded.
+
+    :param item: DynamoDB item
+    :type item: dict
+
+    :return: hex digest of the item's content
+    :rtype: str
+    """
+    content = {key: value for key, value in item.items() if key != VERSION_ATTRIBUTE}
+    serialized = json.dumps(content, sort_keys=True, use_decimal=True)
+    return hashlib.sha1(serialized.encode('utf-8')).hexdigest()
+
+
+def etag_matches(etag: str, if_none_match: Optional[str]) -> bool:
+    """Check whether an 'If-None-Match' header matches an ETag
+
+    The header may list several ETags, may use the '*' wildcard and may
+    contain weak validators, which are compared weakly per RFC 7232.
+
+    :param etag: the current ETag of the resource
+    :type etag: str
+    :param if_none_match: value of the request's 'If-None-Match' header
+    :type if_none_match: str
+
+    :return: True if the client's cached copy is still valid
+    :rtype: bool
+    """
+    if not if_none_match:
+        return False
+
+    candidates = [candidate.strip() for candidate in if_none_match.split(',')]
+    if '*' in candidates:
+        return True
+    return any((candidate[2:] if candidate.startswith('W/') else candidate) == etag
+               for candidate in candidates)
+
+
+def negotiate_encoding(accept_encoding: Optional[str]) -> Optional[str]:
+    """Choose a supported content encoding from an 'Accept-Encoding' header
+
+    Encodings are ranked by their quality values; ties are resolved by the
+    order of CONTENT_ENCODERS. Encodings with a zero quality value are never
+    chosen. The '*' wildcard accepts any supported encoding.
+
+    :param accept_encoding: value of the request's 'Accept-Encoding' header
+    :type accept_encoding: str
+
+    :return: chosen content encoding or None if the body must be sent as is
+    :rtype: str
+    """
+    if not accept_encoding:
+        return None
+
+    qualities = {}
+    for entry in accept_encoding.split(','):
+        coding, _, params = entry.strip().partition(';')
+        quality = 1.0
+        for param in params.split(';'):
+            name, _, value = param.strip().partition('=')
+            if name == 'q':
+                try:
+                    quality = float(value)
+                except ValueError:
+                    quality = 0.0
+        qualities[coding.strip().lower()] = quality
+
+    best_encoding, best_quality = None, 0.0
+    for encoding in CONTENT_ENCODERS.keys():
+        quality = qualities.get(encoding, qualities.get('*', 0.0))
+        if quality > best_quality:
+            best_encoding, best_quality = encoding, quality
+    return best_encoding
+
+
+def compress_response(response: Dict[str, Any], event: Dict[str, Any]) -> Dict[str, Any]:
+    """Compress an HTTP response's body according to the request's 'Accept-Encoding'
+
+    Bodies shorter than the environment variable 'COMPRESSION_MIN_SIZE' (in bytes)
+    are returned uncompressed, as compression would not pay for itself. Compressed
+    bodies are base64-encoded with 'isBase64Encoded' set, so API Gateway sends
+    them as binary, and the 'Content-Encoding' header is set. The environment
+    variable 'COMPRESSION_LEVEL' selects the compression level (1-9).
+
+    :param response: HTTP status response of an operation processing function
+    :type response: dict
+    :param event: deserialized API Gateway event
+    :type event: dict
+
+    :return: HTTP status response, possibly with a compressed body
+    :rtype: dict
+    """
+    body = response.get('body')
+    if not body:  # e.g. 304 Not Modified
+        return response
+
+    headers = {**response.get('headers', {}), 'Vary': 'Accept-Encoding'}
+    data = body.encode('utf-8')
+    min_size = int(os.environ.get('COMPRESSION_MIN_SIZE', COMPRESSION_MIN_SIZE))
+    encoding = negotiate_encoding(get_header(event, 'Accept-Encoding'))
+    if encoding is None or len(data) < min_size:
+        return {**response, 'headers': headers}
+
+    level = int(os.environ.get('COMPRESSION_LEVEL', COMPRESSION_LEVEL))
+    headers['Content-Encoding'] = encoding
+    return {
+        **response,
+        'headers': headers,
+        'body': base64.b64encode(CONTENT_ENCODERS[encoding](data, level)).decode('ascii'),
+        'isBase64Encoded': True,
+    }
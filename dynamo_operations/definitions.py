@@ -1,9 +1,10 @@
-from datetime import timedelta
+# Reserved item attribute holding the content version, used as the item's ETag;
+# it is never returned to clients, so it cannot clash with their own attributes
+VERSION_ATTRIBUTE = '_etag'
+# Cache-Control header returned alongside read responses
+READ_CACHE_CONTROL = 'max-age=5'
 
-import pytz
-
-
-EXPIRY_DELTA = timedelta(days=3)
-REGION_TIMEZONES = {
-    'eu-west-1': pytz.timezone('Europe/Dublin')
-}
+# Response compression defaults, overridden by the 'COMPRESSION_LEVEL' and
+# 'COMPRESSION_MIN_SIZE' environment variables
+COMPRESSION_LEVEL = 6
+COMPRESSION_MIN_SIZE = 1024  # bytes
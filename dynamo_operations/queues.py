@@ -0,0 +1,75 @@
+import uuid
+from typing import Dict, Any, List
+
+
+class SqsQueue:
+    """FIFO SQS queue of asynchronous write operations
+
+    Messages of the same group are delivered in the order they were sent,
+    so writes of the same item are applied in order by the drain function.
+
+    :param queue_url: SQS queue URL
+    :type queue_url: str
+    :param client: boto3 SQS client
+    :type client: botocore.client.SQS
+    """
+
+    def __init__(self, queue_url: str, client: 'botocore.client.SQS') -> None:
+        self.queue_url = queue_url
+        self.client = client
+
+    def send(self, body: str, group_id: str, deduplication_id: str) -> None:
+        """Send a message to the queue
+
+        :param body: message body
+        :type body: str
+        :param group_id: message group, i.e. the digest of the written item's primary key value
+        :type group_id: str
+        :param deduplication_id: message deduplication id, i.e. the request id
+        :type deduplication_id: str
+
+        :raises botocore.exceptions.ClientError: boto3 client error when sending the message
+        """
+        self.client.send_message(QueueUrl=self.queue_url, MessageBody=body,
+                                 MessageGroupId=group_id, MessageDeduplicationId=deduplication_id)
+
+
+class LocalQueue:
+    """In-memory stand-in for SqsQueue, used in tests and local invocations
+
+    Sent messages are kept in order and can be turned into the SQS event the
+    drain function would receive.
+    """
+
+    def __init__(self) -> None:
+        self.messages: List[Dict[str, Any]] = []
+
+    def send(self, body: str, group_id: str, deduplication_id: str) -> None:
+        """Keep a message in memory
+
+        :param body: message body
+        :type body: str
+        :param group_id: message group
+        :type group_id: str
+        :param deduplication_id: message deduplication id
+        :type deduplication_id: str
+        """
+        self.messages.append({
+            'messageId': str(uuid.uuid4()),
+            'body': body,
+            'attributes': {
+                'MessageGroupId': group_id,
+                'MessageDeduplicationId': deduplication_id
+            },
+            'eventSource': 'aws:sqs'
+        })
+
+    def receive_event(self) -> Dict[str, Any]:
+        """Remove all kept messages and return them as an SQS event
+
+        :return: SQS Lambda event
+        :rtype: dict
+        """
+        event = {'Records': self.messages}
+        self.messages = []
+        return event
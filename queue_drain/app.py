@@ -0,0 +1,154 @@
+import os
+import logging
+from typing import Dict, Any, List, Tuple
+
+import simplejson as json
+import boto3
+
+try:  # when the common Lambda layer is installed
+    from batching import BatchWriter
+    from resilience import Resilience, ServiceUnavailableError
+except ImportError:  # when Lambda handler is imported in another file
+    from common.batching import BatchWriter
+    from common.resilience import Resilience, ServiceUnavailableError
+
+
+logger = logging.getLogger()
+logger.setLevel(logging.INFO)
+
+# DynamoDB calls are retried, rate limited and circuit broken per container
+resilience = Resilience('queue_drain')
+# Created once per container, so botocore's adaptive rate limiter persists across invocations
+dynamodb = boto3.resource('dynamodb', config=resilience.client_config())
+
+
+def lambda_handler(event: Dict[str, Any], context: 'LambdaContext') -> Dict[str, Any]:
+    """Apply a batch of queued write operations to the DynamoDB table
+
+    Each SQS message holds an 'insert' or 'delete' operation queued by
+    dynamo_operations, with the prepared 'Item' to insert or the 'Key' to delete.
+    Operations on the same key are coalesced, the last one winning, and the
+    remaining writes are applied with BatchWriteItem (see BatchWriter).
+
+    Messages which can never be applied, i.e. malformed messages (see
+    parse_message) and messages whose write DynamoDB rejects, are reported in
+    'batchItemFailures' on their own; batches DynamoDB rejects are split to find
+    them. Once a message has been received 'maxReceiveCount' times, SQS moves
+    it to the dead-letter queue, which unblocks its message group. Operations a
+    rejected message superseded in the same batch are not applied either, so
+    their messages are reported as well.
+
+    Upon success a 200 Success HTTP status is returned with the number of
+    messages, of applied writes and of failed messages. If DynamoDB is unavailable, a 503 HTTP
+    status is returned and every message is reported in 'batchItemFailures',
+    so the whole batch is retried; writes are idempotent, so re-applying the
+    already written part of the batch is harmless.
+
+    The environment variable 'TABLE_NAME' specifies the DynamoDB table.
+
+    :param event: deserialized SQS Lambda event
+    :type event: dict
+    :param context: Lambda function context
+    :type context: LambdaContext
+
+    :raises KeyError: environment variable 'TABLE_NAME' is not defined
+
+    :return: HTTP status response
+    :rtype: dict
+    """
+    table_name = os.environ.get('TABLE_NAME')
+    writer = BatchWriter(dynamodb, table_name, resilience, isolate_rejected=True)
+
+    resilience.bind(context)
+    failures = []
+    sources = {}  # ids of the messages coalesced into each buffered key
+    try:
+        for record in event['Records']:  # coalesce the queued operations
+            try:
+                operation, payload = parse_message(record)
+            except ValueError as e:
+                logger.error(f"Failing malformed message {record['messageId']}: {e}")
+                failures.append(record['messageId'])
+                continue
+
+            sources.setdefault(payload['id'], []).append(record['messageId'])
+            if operation == 'insert':
+                writer.put(payload)
+            else:
+                writer.delete(payload)
+            failures += rejected_messages(writer, sources)
+        writer.flush()
+        failures += rejected_messages(writer, sources)
+    except ServiceUnavailableError as e:
+        logger.exception(e)
+        response = {
+            'statusCode': 503,
+            'body': json.dumps({
+                'message': str(e)
+            }),
+            'batchItemFailures': [{'itemIdentifier': record['messageId']} for record in event['Records']]
+        }
+    else:
+        response = {
+            'statusCode': 200,
+            'body': json.dumps({
+                'message': f"Successfully applied queued operations to {table_name}",
+                'messages': len(event['Records']),
+                'writes': writer.written,
+                'failures': len(failures)
+            }),
+            'batchItemFailures': [{'itemIdentifier': message_id} for message_id in failures]
+        }
+    finally:
+        resilience.metrics.flush()
+
+    logger.info(response)
+    return response
+
+
+def parse_message(record: Dict[str, Any]) -> Tuple[str, Dict[str, Any]]:
+    """Parse the operation of a queued write message
+
+    :param record: SQS message record
+    :type record: dict
+
+    :raises ValueError: the message is not valid JSON, its operation is neither
+        'insert' nor 'delete' or its payload lacks a string primary key ('id')
+
+    :return: the operation and the 'Item' to insert or the 'Key' to delete
+    :rtype: tuple
+    """
+    message = json.loads(record['body'], use_decimal=True)
+    operation = message.get('operation') if isinstance(message, dict) else None
+    if operation not in ('insert', 'delete'):
+        raise ValueError(f"Invalid operation ({operation})")
+
+    payload = message.get('payload')
+    payload = payload.get('Item' if operation == 'insert' else 'Key') if isinstance(payload, dict) else None
+    if not isinstance(payload, dict) or not isinstance(payload.get('id'), str):
+        raise ValueError(f"Invalid {operation} payload without a string primary key ('id')")
+    return operation, payload
+
+
+def rejected_messages(writer: BatchWriter, sources: Dict[str, List[str]]) -> List[str]:
+    """Take the ids of the messages whose writes DynamoDB has rejected so far
+
+    Every message coalesced into a rejected write is taken, and keys which are
+    no longer buffered are dropped from the sources, as their writes are done.
+
+    :param writer: batch writer of the queued operations
+    :type writer: BatchWriter
+    :param sources: ids of the messages coalesced into each buffered key
+    :type sources: dict
+
+    :return: SQS message ids
+    :rtype: list
+    """
+    message_ids = []
+    for key, error in writer.rejected:
+        logger.error(f"Failing messages {', '.join(sources[key])} rejected by DynamoDB: {error}")
+        message_ids += sources[key]
+    writer.rejected = []
+    for key in [key for key in sources if key not in writer.pending]:
+        del sources[key]
+    return message_ids
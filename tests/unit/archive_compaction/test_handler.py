@@ -0,0 +1,87 @@
+import os
+import gzip
+import json
+from typing import Dict, Any
+
+import pytest
+import boto3
+
+from archive_compaction import app
+
+
+@pytest.fixture()
+def archived_images() -> Dict[str, Any]:
+    return {
+        'CompactionTestTable/2021-08-06/101_333.json': {
+            'message': {'S': 'This item has changed'},
+            'id': {'S': '101'}
+        },
+        'CompactionTestTable/2021-08-06/100_334.json': {
+            'message': {'S': 'This item has changed too'},
+            'id': {'S': '100'}
+        }
+    }
+
+
+@pytest.fixture()
+def destination_bucket(monkeypatch: pytest.MonkeyPatch) -> str:
+    bucket = os.environ.get('DESTINATION_BUCKET')
+    if bucket is None:
+        raise KeyError("Missing required environmental variable 'DESTINATION_BUCKET'")
+    monkeypatch.setenv('ARCHIVE_BUCKET', bucket)
+    monkeypatch.setenv('TABLE_NAME', 'CompactionTestTable')
+    return bucket
+
+
+def test_lambda_handler(archived_images: Dict[str, Any], destination_bucket: str) -> None:
+    # Connect to the destination test bucket and archive the test records
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+    for key, image in archived_images.items():
+        bucket.put_object(Key=key, Body=json.dumps(image))
+    spool_entry = {
+        'key': 'CompactionTestTable/2021-08-06/102_335.json',
+        'sequence': '335',
+        'image': {'id': {'S': '102'}}
+    }
+    bucket.put_object(Key='CompactionTestTable/2021-08-06/spool_335_335.jsonl.gz',
+                      Body=gzip.compress((json.dumps(spool_entry) + '\n').encode('utf-8')))
+
+    try:
+        response = app.lambda_handler({'date': '2021-08-06'}, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['objects'] == 3
+        assert data['records'] == 3
+
+        # Make sure the records have been compacted and the originals deleted
+        body = bucket.Object('compacted/CompactionTestTable/2021-08-06.jsonl.gz').get()['Body'].read()
+        entries = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+        assert sorted(entry['sequence'] for entry in entries) == ['333', '334', '335']
+        index = json.loads(bucket.Object('compacted/CompactionTestTable/2021-08-06.index.json').get()['Body'].read())
+        assert [record_id for record_id, _ in index['ids']] == ['100', '101', '102']
+        assert list(bucket.objects.filter(Prefix='CompactionTestTable/2021-08-06/')) == []
+
+        # Compact a late arrival into the existing compacted object
+        bucket.put_object(Key='CompactionTestTable/2021-08-06/103_336.json', Body=json.dumps({'id': {'S': '103'}}))
+        response = app.lambda_handler({'date': '2021-08-06'}, None)
+        data = json.loads(response['body'])
+        assert data['objects'] == 1
+        assert data['records'] == 4
+        assert [summary.key for summary in bucket.objects.filter(Prefix='compacted/CompactionTestTable/')] == [
+            'compacted/CompactionTestTable/2021-08-06.index.json',
+            'compacted/CompactionTestTable/2021-08-06.jsonl.gz'
+        ]
+    finally:
+        # Delete generated objects from S3 bucket
+        delete_list = [{'Key': summary.key} for summary in bucket.objects.filter(Prefix='CompactionTestTable/')]
+        delete_list += [{'Key': summary.key} for summary in bucket.objects.filter(Prefix='compacted/CompactionTestTable/')]
+        bucket.delete_objects(Delete={'Objects': delete_list})
+
+
+def test_lambda_handler_without_archived_objects(destination_bucket: str) -> None:
+    response = app.lambda_handler({'date': '2000-01-01'}, None)
+    data = json.loads(response['body'])
+    assert response['statusCode'] == 200
+    assert data['objects'] == 0
+    assert data['records'] == 0
@@ -0,0 +1,144 @@
+import os
+import gzip
+import json
+from typing import Dict, Any
+
+import pytest
+import boto3
+
+from archive_restore import app
+
+
+@pytest.fixture()
+def table_name() -> str:
+    name = os.environ.get('TABLE_NAME')
+    if name is None:
+        raise KeyError("Missing required environmental variable 'TABLE_NAME'")
+    return name
+
+
+@pytest.fixture()
+def destination_bucket(monkeypatch: pytest.MonkeyPatch) -> str:
+    bucket = os.environ.get('DESTINATION_BUCKET')
+    if bucket is None:
+        raise KeyError("Missing required environmental variable 'DESTINATION_BUCKET'")
+    monkeypatch.setenv('ARCHIVE_BUCKET', bucket)
+    return bucket
+
+
+@pytest.fixture()
+def archived_images(table_name: str) -> Dict[str, Any]:
+    return {
+        f'{table_name}/2021-08-06/1234567890_333.json': {
+            'id': {'S': '1234567890'},
+            'name': {'S': 'test_item'},
+            'count': {'N': '3'},
+            'expiration_time': {'N': '1628517803'}
+        },
+        f'{table_name}/2021-08-07/1234567891_334.json': {
+            'id': {'S': '1234567891'},
+            'name': {'S': 'other_test_item'}
+        }
+    }
+
+
+def test_lambda_handler(archived_images: Dict[str, Any], table_name: str, destination_bucket: str) -> None:
+    # Archive the test records
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+    for key, image in archived_images.items():
+        bucket.put_object(Key=key, Body=json.dumps(image))
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+
+    try:
+        # Make sure a dry run does not restore anything
+        response = app.lambda_handler({'start': '2021-08-06', 'end': '2021-08-07', 'dry_run': True}, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['complete'] is True
+        assert data['restored'] == 2
+        assert 'Item' not in table.get_item(Key={'id': '1234567890'}).keys()
+
+        # Restore a single record of the time window
+        response = app.lambda_handler({'start': '2021-08-06', 'end': '2021-08-07', 'ids': ['1234567890']}, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['complete'] is True
+        assert data['restored'] == 1
+        assert data['skipped'] == 1
+        restore_id = data['restore_id']
+
+        item = table.get_item(Key={'id': '1234567890'})['Item']
+        assert item['name'] == 'test_item'
+        assert item['count'] == 3
+        assert item['expiration_time'] > 1628517803
+        assert 'Item' not in table.get_item(Key={'id': '1234567891'}).keys()
+
+        # Make sure a repeated restore resumes from its completed checkpoint
+        response = app.lambda_handler({'start': '2021-08-06', 'end': '2021-08-07', 'ids': ['1234567890']}, None)
+        data = json.loads(response['body'])
+        assert data['restore_id'] == restore_id
+        assert data['complete'] is True
+        assert data['restored'] == 1
+    finally:
+        # Delete generated objects and items
+        delete_list = [{'Key': key} for key in archived_images.keys()]
+        delete_list += [{'Key': summary.key} for summary in bucket.objects.filter(Prefix='restore-checkpoints/')]
+        bucket.delete_objects(Delete={'Objects': delete_list})
+        table.delete_item(Key={'id': '1234567890'})
+
+
+class FakeContext:
+    def get_remaining_time_in_millis(self) -> int:
+        return 0
+
+
+def test_lambda_handler_with_compacted_archive(table_name: str, destination_bucket: str,
+                                               monkeypatch: pytest.MonkeyPatch) -> None:
+    # Archive the test records in a compacted archive
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+    entries = [{
+        'key': f'{table_name}/2021-08-08/{record_id}_{record_id}.json',
+        'sequence': str(record_id),
+        'image': {'id': {'S': str(record_id)}, 'name': {'S': 'test_item'}}
+    } for record_id in range(1234567890, 1234567893)]
+    compacted_key = f'compacted/{table_name}/2021-08-08.jsonl.gz'
+    bucket.put_object(Key=compacted_key,
+                      Body=gzip.compress(''.join(json.dumps(entry) + '\n' for entry in entries).encode('utf-8')))
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+
+    try:
+        # Make sure a compacted-only day is restored in full without checkpointing within it
+        response = app.lambda_handler({'start': '2021-08-08', 'restore_id': 'compacted-only'}, None)
+        data = json.loads(response['body'])
+        assert data['complete'] is True
+        assert data['restored'] == 3
+        for entry in entries:
+            assert table.get_item(Key={'id': entry['image']['id']['S']})['Item']['name'] == 'test_item'
+            table.delete_item(Key={'id': entry['image']['id']['S']})
+
+        # Make sure a restore about to time out is suspended within the compacted archive
+        monkeypatch.setattr(app, 'RESTORE_CHECKPOINT_LINES', 1)
+        response = app.lambda_handler({'start': '2021-08-08'}, FakeContext())
+        data = json.loads(response['body'])
+        assert data['complete'] is False
+        assert data['restored'] == 1
+        checkpoint = json.loads(bucket.Object(f"restore-checkpoints/{data['restore_id']}.json").get()['Body'].read())
+        assert checkpoint['positions']['2021-08-08'] == {'key': compacted_key, 'line': 1}
+
+        # Make sure the resumed restore continues after the checkpointed line
+        response = app.lambda_handler({'start': '2021-08-08'}, None)
+        data = json.loads(response['body'])
+        assert data['complete'] is True
+        assert data['restored'] == 3
+        assert table.get_item(Key={'id': '1234567892'})['Item']['name'] == 'test_item'
+    finally:
+        # Delete generated objects and items
+        delete_list = [{'Key': compacted_key}]
+        delete_list += [{'Key': summary.key} for summary in bucket.objects.filter(Prefix='restore-checkpoints/')]
+        bucket.delete_objects(Delete={'Objects': delete_list})
+        for entry in entries:
+            table.delete_item(Key={'id': entry['image']['id']['S']})
@@ -0,0 +1,112 @@
+from typing import Callable
+
+import pytest
+import botocore.exceptions
+
+from common.resilience import Resilience, CircuitBreaker, ServiceUnavailableError
+
+
+class FakeContext:
+    def __init__(self, remaining_time: int) -> None:
+        self.remaining_time = remaining_time
+
+    def get_remaining_time_in_millis(self) -> int:
+        return self.remaining_time
+
+
+def failing_call(code: str, failures: int) -> Callable[[], str]:
+    calls = {'count': 0}
+
+    def call() -> str:
+        calls['count'] += 1
+        if calls['count'] <= failures:
+            raise botocore.exceptions.ClientError({'Error': {'Code': code}}, 'PutItem')
+        return 'success'
+
+    call.calls = calls
+    return call
+
+
+def test_call_retries_throttled_errors() -> None:
+    resilience = Resilience('test', max_attempts=4)
+    call = failing_call('ProvisionedThroughputExceededException', 2)
+
+    assert resilience.call(call) == 'success'
+    assert call.calls['count'] == 3
+    assert resilience.metrics.counters['Throttles'] == 2
+    assert resilience.metrics.counters['Retries'] == 2
+
+
+def test_call_raises_non_retryable_errors() -> None:
+    resilience = Resilience('test')
+    call = failing_call('ConditionalCheckFailedException', 1)
+
+    with pytest.raises(botocore.exceptions.ClientError):
+        resilience.call(call)
+    assert call.calls['count'] == 1
+    assert resilience.breaker.failures == 0
+
+
+def test_call_stops_retrying_at_lambda_timeout() -> None:
+    resilience = Resilience('test', max_attempts=10)
+    resilience.bind(FakeContext(remaining_time=100))
+    call = failing_call('ThrottlingException', 10)
+
+    with pytest.raises(ServiceUnavailableError):
+        resilience.call(call)
+    assert call.calls['count'] == 1
+
+
+def test_call_only_retries_when_an_attempt_fits_before_lambda_timeout() -> None:
+    resilience = Resilience('test', max_attempts=10)
+    resilience.bind(FakeContext(remaining_time=2000))
+    call = failing_call('ThrottlingException', 10)
+
+    # A retry could still be waiting on its read timeout when the Lambda times out
+    with pytest.raises(ServiceUnavailableError):
+        resilience.call(call)
+    assert call.calls['count'] == 1
+
+    resilience.bind(FakeContext(remaining_time=10000))
+    call = failing_call('ThrottlingException', 1)
+    assert resilience.call(call) == 'success'
+    assert call.calls['count'] == 2
+
+
+def test_circuit_breaker_fails_fast_while_open() -> None:
+    resilience = Resilience('test', max_attempts=1, breaker=CircuitBreaker(failure_threshold=2, reset_timeout=60))
+    call = failing_call('SlowDown', 2)
+
+    for _ in range(2):
+        with pytest.raises(ServiceUnavailableError):
+            resilience.call(call)
+    with pytest.raises(ServiceUnavailableError) as e:
+        resilience.call(call)
+    assert call.calls['count'] == 2
+    assert 0 < e.value.retry_after <= 60
+    assert resilience.metrics.counters['CircuitOpen'] == 1
+
+
+def test_circuit_breaker_closes_after_successful_trial() -> None:
+    resilience = Resilience('test', max_attempts=1, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0))
+    call = failing_call('SlowDown', 1)
+
+    with pytest.raises(ServiceUnavailableError):
+        resilience.call(call)
+    assert resilience.call(call) == 'success'
+    assert resilience.breaker.opened_at is None
+
+
+def test_circuit_breaker_allows_new_trial_after_local_error() -> None:
+    resilience = Resilience('test', max_attempts=1, breaker=CircuitBreaker(failure_threshold=1, reset_timeout=0))
+    with pytest.raises(ServiceUnavailableError):
+        resilience.call(failing_call('SlowDown', 1))
+
+    def invalid_call() -> str:
+        raise botocore.exceptions.ParamValidationError(report='Missing required parameter')
+
+    # The trial call fails before reaching the service, so the next call is a trial again
+    with pytest.raises(botocore.exceptions.ParamValidationError):
+        resilience.call(invalid_call)
+    assert resilience.call(failing_call('SlowDown', 0)) == 'success'
+    assert resilience.breaker.opened_at is None
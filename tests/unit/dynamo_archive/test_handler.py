@@ -1,9 +1,13 @@
+import io
 import os
+import copy
+import gzip
 import json
 from typing import Dict, Any
 
 import pytest
 import boto3
+from boto3.dynamodb.conditions import Key
 
 from dynamo_archive import app
 
@@ -19,6 +23,7 @@ def ddb_stream_event() -> Dict[str, Any]:
                 "eventSource": "aws:dynamodb",
                 "awsRegion": "{region}",
                 "dynamodb": {
+                    "ApproximateCreationDateTime": 1628258603,
                     "Keys": {
                         "Id": {
                             "N": "101"
@@ -53,6 +58,7 @@ def ddb_stream_invalid_event() -> Dict[str, Any]:
                 "eventSource": "aws:dynamodb",
                 "awsRegion": "{region}",
                 "dynamodb": {
+                    "ApproximateCreationDateTime": 1628258603,
                     "Keys": {
                         "Id": {
                             "N": "101"
@@ -76,6 +82,12 @@ def ddb_stream_invalid_event() -> Dict[str, Any]:
     }
 
 
+@pytest.fixture(autouse=True)
+def clear_archived_keys() -> None:
+    # Archived objects are deleted between tests, so forget the container's archived keys
+    app.archived_keys.clear()
+
+
 @pytest.fixture()
 def destination_bucket() -> str:
     bucket = os.environ.get('DESTINATION_BUCKET')
@@ -84,6 +96,14 @@ def destination_bucket() -> str:
     return bucket
 
 
+@pytest.fixture()
+def schema_table() -> str:
+    name = os.environ.get('ARCHIVE_SCHEMA_TABLE')
+    if name is None:
+        raise KeyError("Missing required environmental variable 'ARCHIVE_SCHEMA_TABLE'")
+    return name
+
+
 def count_objects_in_s3_bucket(bucket: 'boto3.resources.factory.s3.Bucket') -> int:
     count = 0
     for _ in bucket.objects.all():
@@ -116,6 +136,160 @@ def test_lambda_handler(ddb_stream_event: Dict[str, Any], destination_bucket: st
         bucket.delete_objects(Delete={'Objects': delete_list})
 
 
+def test_lambda_handler_with_retried_event(ddb_stream_event: Dict[str, Any], destination_bucket: str) -> None:
+    # Connect to the destination test bucket
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+    initial_object_count = count_objects_in_s3_bucket(bucket)
+
+    # Call the lambda handler twice with the same DynamoDB streams event
+    response = app.lambda_handler(ddb_stream_event, None)
+    data = json.loads(response['body'])
+    retry_response = app.lambda_handler(ddb_stream_event, None)
+    retry_data = json.loads(retry_response['body'])
+
+    try:
+        assert response['statusCode'] == 200
+        assert retry_response['statusCode'] == 200
+        assert data['records'] == ['ExampleTableWithStream/2021-08-06/101_333.json']
+        assert retry_data['records'] == data['records']
+        assert retry_data['skipped'] == data['records']
+        assert retry_response['batchItemFailures'] == []
+        assert count_objects_in_s3_bucket(bucket) == initial_object_count + 1
+    except AssertionError:
+        raise
+    finally:
+        # Delete generated objects from S3 bucket
+        delete_list = [{'Key': record_key} for record_key in data['records']]
+        bucket.delete_objects(Delete={'Objects': delete_list})
+
+
+def test_lambda_handler_with_spooled_event(ddb_stream_event: Dict[str, Any], destination_bucket: str,
+                                           monkeypatch: pytest.MonkeyPatch) -> None:
+    # Connect to the destination test bucket
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+    initial_object_count = count_objects_in_s3_bucket(bucket)
+
+    # Call the lambda handler in spool mode
+    monkeypatch.setenv('ARCHIVE_SPOOL', 'true')
+    response = app.lambda_handler(ddb_stream_event, None)
+    data = json.loads(response['body'])
+
+    try:
+        assert response['statusCode'] == 200
+        assert response['batchItemFailures'] == []
+        assert data['records'] == ['ExampleTableWithStream/2021-08-06/spool_333_333.jsonl.gz']
+        assert count_objects_in_s3_bucket(bucket) == initial_object_count + 1
+
+        # Make sure the spooled record has been archived
+        body = bucket.Object(data['records'][0]).get()['Body'].read()
+        entries = [json.loads(line) for line in gzip.decompress(body).splitlines()]
+        assert len(entries) == 1
+        assert entries[0]['key'] == 'ExampleTableWithStream/2021-08-06/101_333.json'
+        assert entries[0]['sequence'] == '333'
+        assert entries[0]['image'] == ddb_stream_event['Records'][0]['dynamodb']['OldImage']
+    except AssertionError:
+        raise
+    finally:
+        # Delete generated objects from S3 bucket
+        delete_list = [{'Key': record_key} for record_key in data['records']]
+        bucket.delete_objects(Delete={'Objects': delete_list})
+
+
+def test_lambda_handler_with_spool_spanning_days(ddb_stream_event: Dict[str, Any], destination_bucket: str,
+                                                 monkeypatch: pytest.MonkeyPatch) -> None:
+    # Connect to the destination test bucket
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+
+    # Remove a second record on the next day
+    next_day_record = copy.deepcopy(ddb_stream_event['Records'][0])
+    next_day_record['dynamodb']['ApproximateCreationDateTime'] += 24 * 60 * 60
+    next_day_record['dynamodb']['SequenceNumber'] = '334'
+    ddb_stream_event['Records'].append(next_day_record)
+
+    # Call the lambda handler in spool mode
+    monkeypatch.setenv('ARCHIVE_SPOOL', 'true')
+    response = app.lambda_handler(ddb_stream_event, None)
+    data = json.loads(response['body'])
+
+    try:
+        # Make sure each day's records have been archived under their own day
+        assert response['statusCode'] == 200
+        assert data['records'] == ['ExampleTableWithStream/2021-08-06/spool_333_333.jsonl.gz',
+                                   'ExampleTableWithStream/2021-08-07/spool_334_334.jsonl.gz']
+    except AssertionError:
+        raise
+    finally:
+        # Delete generated objects from S3 bucket
+        delete_list = [{'Key': record_key} for record_key in data['records']]
+        bucket.delete_objects(Delete={'Objects': delete_list})
+
+
+def test_lambda_handler_with_parquet_event(ddb_stream_event: Dict[str, Any], destination_bucket: str,
+                                           schema_table: str, monkeypatch: pytest.MonkeyPatch) -> None:
+    parquet = pytest.importorskip('pyarrow.parquet')
+
+    # Connect to the destination test bucket and the column registry
+    s3 = boto3.resource('s3')
+    bucket = s3.Bucket(destination_bucket)
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(schema_table)
+
+    # Archive a second record with a new attribute and a conflicting type in a later invocation
+    evolved_event = copy.deepcopy(ddb_stream_event)
+    evolved_record = evolved_event['Records'][0]['dynamodb']
+    evolved_record['OldImage'] = {
+        'id': {'S': '102'},
+        'message': {'N': '5'},
+        'count': {'N': '12345678901234567890'}
+    }
+    evolved_record['SequenceNumber'] = '334'
+
+    # Call the lambda handler with Parquet files alongside the JSON archive
+    monkeypatch.setenv('ARCHIVE_PARQUET', 'true')
+    monkeypatch.setattr(app, 'schema_registry', None)
+    response = app.lambda_handler(ddb_stream_event, None)
+    evolved_response = app.lambda_handler(evolved_event, None)
+    record_keys = json.loads(response['body'])['records'] + json.loads(evolved_response['body'])['records']
+
+    try:
+        assert response['statusCode'] == 200
+        assert evolved_response['statusCode'] == 200
+        assert record_keys == ['ExampleTableWithStream/2021-08-06/101_333.json',
+                               'parquet/ExampleTableWithStream/removal_date=2021-08-06/333_333.parquet',
+                               'ExampleTableWithStream/2021-08-06/102_334.json',
+                               'parquet/ExampleTableWithStream/removal_date=2021-08-06/334_334.parquet']
+
+        # Make sure the JSON archive keeps the exact number
+        body = bucket.Object(record_keys[2]).get()['Body'].read()
+        assert json.loads(body)['count'] == {'N': '12345678901234567890'}
+
+        # Make sure the registered columns have kept their first type
+        items = table.query(KeyConditionExpression=Key('table_name').eq('ExampleTableWithStream'))['Items']
+        assert {item['column_name']: item['column_type'] for item in items} == {
+            'count': 'double',
+            'id': 'string',
+            'message': 'string',
+            'message__double': 'double'
+        }
+
+        # Make sure the conflicting value has been written to its own column
+        body = bucket.Object(record_keys[3]).get()['Body'].read()
+        rows = parquet.read_table(io.BytesIO(body))
+        assert rows.column_names == ['count', 'id', 'message__double', '_sequence_number']
+        assert rows.to_pylist() == [{'count': 12345678901234567890.0, 'id': '102', 'message__double': 5.0,
+                                     '_sequence_number': '334'}]
+    except AssertionError:
+        raise
+    finally:
+        # Delete generated objects from S3 bucket and registered columns
+        bucket.delete_objects(Delete={'Objects': [{'Key': record_key} for record_key in record_keys]})
+        for item in table.query(KeyConditionExpression=Key('table_name').eq('ExampleTableWithStream'))['Items']:
+            table.delete_item(Key={'table_name': item['table_name'], 'column_name': item['column_name']})
+
+
 def test_lambda_handler_with_invalid_event(ddb_stream_invalid_event: Dict[str, Any],
                                            destination_bucket: str) -> None:
     # Connect to the destination test bucket
@@ -1,11 +1,15 @@
 import json
 import os
+import gzip
+import base64
+import hashlib
 from typing import Dict, Any
 
 import pytest
 import boto3
 
 from dynamo_operations import app
+from dynamo_operations.queues import LocalQueue
 
 
 @pytest.fixture()
@@ -258,6 +262,24 @@ def apigw_invalid_operation_event() -> Dict[str, Any]:
     }
 
 
+@pytest.fixture()
+def apigw_bulk_event(apigw_insert_event: Dict[str, Any]) -> Dict[str, Any]:
+    body = {
+        "operation": "bulk",
+        "payload": {
+            "Operations": [
+                {"operation": "insert", "payload": {"Item": {"id": "1234567890", "name": "test_item"}}},
+                {"operation": "delete", "payload": {"Key": {"id": "1234567891"}}},
+                {"operation": "insert", "payload": {"Item": {"id": "1234567891", "name": "test_item"}}},
+                {"operation": "insert", "payload": {"Item": {"id": "1234567890", "name": "new_item"}}},
+                {"operation": "delete", "payload": {"Key": {"id": "1234567891"}}},
+                {"operation": "delete", "payload": {"Key": {"id": "1234567892"}}}
+            ]
+        }
+    }
+    return {**apigw_insert_event, "body": json.dumps(body)}
+
+
 @pytest.fixture()
 def table_name() -> str:
     name = os.environ.get('TABLE_NAME')
@@ -297,6 +319,7 @@ def test_lambda_handler_with_insert_event(apigw_insert_event: Dict[str, Any],
         assert 'name' in item.keys()
         assert item['name'] == 'test_item'
         assert 'expiration_time' in item.keys()
+        assert '_etag' in item.keys()
     finally:
         # Ensure the test item is deleted
         table.delete_item(
@@ -305,6 +328,59 @@ def test_lambda_handler_with_insert_event(apigw_insert_event: Dict[str, Any],
         )
 
 
+def test_lambda_handler_with_async_insert_event(apigw_insert_event: Dict[str, Any],
+                                                table_name: str,
+                                                monkeypatch: pytest.MonkeyPatch) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+    queue = LocalQueue()
+    monkeypatch.setattr(app, 'write_queue', queue)
+
+    # Execute the Lambda handler with the test event in async mode
+    body = json.loads(apigw_insert_event['body'])
+    body['async'] = True
+    apigw_insert_event['body'] = json.dumps(body)
+    response = app.lambda_handler(apigw_insert_event, None)
+    data = json.loads(response['body'])
+    assert response['statusCode'] == 202
+    assert data['table'] == table_name
+    assert data['item']['id'] == '1234567890'
+    assert data['request_id'] == 'c6af9ac6-7b61-11e6-9a41-93e8deadbeef'
+
+    # Make sure the operation has been queued instead of written
+    assert len(queue.messages) == 1
+    message = json.loads(queue.messages[0]['body'])
+    assert message['operation'] == 'insert'
+    assert message['request_id'] == data['request_id']
+    assert message['payload']['Item']['name'] == 'test_item'
+    assert 'expiration_time' in message['payload']['Item'].keys()
+    assert queue.messages[0]['attributes']['MessageGroupId'] == hashlib.sha256(b'1234567890').hexdigest()
+    table_response = table.get_item(Key={'id': '1234567890'})
+    assert 'Item' not in table_response.keys()
+
+    # Make sure writes DynamoDB would always reject are not queued
+    body['payload']['Item']['id'] = 1234567890
+    apigw_insert_event['body'] = json.dumps(body)
+    response = app.lambda_handler(apigw_insert_event, None)
+    assert response['statusCode'] == 400
+    assert len(queue.messages) == 1
+
+
+def test_lambda_handler_with_async_insert_event_without_queue(apigw_insert_event: Dict[str, Any],
+                                                              monkeypatch: pytest.MonkeyPatch) -> None:
+    monkeypatch.setattr(app, 'write_queue', None)
+    monkeypatch.delenv('QUEUE_URL', raising=False)
+
+    # Make sure the write is not accepted when no queue is configured
+    body = json.loads(apigw_insert_event['body'])
+    body['async'] = True
+    apigw_insert_event['body'] = json.dumps(body)
+    response = app.lambda_handler(apigw_insert_event, None)
+    assert response['statusCode'] == 400
+    assert 'QUEUE_URL' in json.loads(response['body'])['message']
+
+
 def test_lambda_handler_with_read_event(apigw_read_event: Dict[str, Any],
                                         table_name: str) -> None:
     # Connect to the test DynamoDB table
@@ -342,6 +418,90 @@ def test_lambda_handler_with_read_event(apigw_read_event: Dict[str, Any],
         )
 
 
+def test_lambda_handler_with_conditional_read_event(apigw_read_event: Dict[str, Any],
+                                                    table_name: str) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+    try:
+        # Preemptively create the test item
+        table.put_item(Item={
+            'id': '1234567890',
+            'name': 'test_item',
+            'version': 1
+        })
+
+        response = app.lambda_handler(apigw_read_event, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['item']['version'] == 1
+        assert '_etag' not in data['item'].keys()
+        assert 'ETag' in response['headers'].keys()
+        assert 'Cache-Control' in response['headers'].keys()
+        etag = response['headers']['ETag']
+
+        # Repeat the read with the received ETag
+        apigw_read_event['headers']['If-None-Match'] = etag
+        response = app.lambda_handler(apigw_read_event, None)
+        assert response['statusCode'] == 304
+        assert response['headers']['ETag'] == etag
+        assert response['body'] == ''
+
+        # Modify the test item and make sure the ETag no longer matches
+        table.put_item(Item={
+            'id': '1234567890',
+            'name': 'modified_test_item',
+            'version': 1
+        })
+        response = app.lambda_handler(apigw_read_event, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert response['headers']['ETag'] != etag
+        assert data['item']['name'] == 'modified_test_item'
+    finally:
+        # Ensure the test item is deleted
+        table.delete_item(
+            Key={'id': '1234567890'},
+            ConditionExpression='attribute_exists(id)'
+        )
+
+
+def test_lambda_handler_with_compressed_read_event(apigw_read_event: Dict[str, Any],
+                                                   table_name: str,
+                                                   monkeypatch: pytest.MonkeyPatch) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+    try:
+        # Preemptively create a test item larger than the compression threshold
+        table.put_item(Item={
+            'id': '1234567890',
+            'name': 'test_item' * 200
+        })
+
+        monkeypatch.setenv('COMPRESSION_MIN_SIZE', '1024')
+        response = app.lambda_handler(apigw_read_event, None)
+        assert response['statusCode'] == 200
+        assert response['isBase64Encoded'] is True
+        assert response['headers']['Content-Encoding'] == 'gzip'
+        data = json.loads(gzip.decompress(base64.b64decode(response['body'])))
+        assert data['item']['name'] == 'test_item' * 200
+
+        # Make sure small responses are not compressed
+        monkeypatch.setenv('COMPRESSION_MIN_SIZE', '1000000')
+        response = app.lambda_handler(apigw_read_event, None)
+        assert response['statusCode'] == 200
+        assert 'Content-Encoding' not in response['headers'].keys()
+        data = json.loads(response['body'])
+        assert data['item']['name'] == 'test_item' * 200
+    finally:
+        # Ensure the test item is deleted
+        table.delete_item(
+            Key={'id': '1234567890'},
+            ConditionExpression='attribute_exists(id)'
+        )
+
+
 def test_lambda_handler_with_invalid_read_event(apigw_read_event: Dict[str, Any],
                                                 table_name: str) -> None:
     # Connect to the test DynamoDB table
@@ -429,8 +589,42 @@ def test_lambda_handler_with_invalid_operation_event(apigw_invalid_operation_eve
     data = json.loads(response['body'])
     assert response['statusCode'] == 400
     assert 'message' in response['body']
-    assert data['message'] == "Invalid DynamoDB operation specified; Valid operations: ['read', 'insert', 'delete']"
+    assert data['message'] == "Invalid DynamoDB operation specified; Valid operations: ['read', 'insert', 'delete', 'bulk']"
 
     # Make sure the test item was not inserted into the table
     table_response = table.get_item(Key={'id': '1234567890'})
     assert 'Item' not in table_response.keys()
+
+
+def test_lambda_handler_with_bulk_event(apigw_bulk_event: Dict[str, Any],
+                                        table_name: str) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+    try:
+        # Preemptively create one of the deleted test items
+        table.put_item(Item={
+            'id': '1234567892',
+            'name': 'test_item'
+        })
+
+        response = app.lambda_handler(apigw_bulk_event, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['table'] == table_name
+        assert [result['statusCode'] for result in data['results']] == [200, 404, 200, 200, 200, 200]
+        assert data['results'][1]['item'] is None
+        assert data['results'][5]['item']['id'] == '1234567892'
+        # Only the last writes of '1234567890' and '1234567892' are applied
+        assert data['writes'] == 2
+
+        table_response = table.get_item(Key={'id': '1234567890'})
+        assert 'Item' in table_response.keys()
+        assert table_response['Item']['name'] == 'new_item'
+        assert 'expiration_time' in table_response['Item'].keys()
+        assert 'Item' not in table.get_item(Key={'id': '1234567891'}).keys()
+        assert 'Item' not in table.get_item(Key={'id': '1234567892'}).keys()
+    finally:
+        # Ensure the test items are deleted
+        for item_pk in ('1234567890', '1234567891', '1234567892'):
+            table.delete_item(Key={'id': item_pk})
@@ -0,0 +1,115 @@
+import os
+import json
+from typing import Dict, Any
+
+import pytest
+import boto3
+
+from queue_drain import app
+from dynamo_operations.queues import LocalQueue
+
+
+def queue_message(operation: str, payload: Dict[str, Any], request_id: str) -> str:
+    return json.dumps({
+        'request_id': request_id,
+        'operation': operation,
+        'payload': payload
+    })
+
+
+@pytest.fixture()
+def sqs_event() -> Dict[str, Any]:
+    queue = LocalQueue()
+    queue.send(queue_message('insert', {'Item': {'id': '1234567890', 'name': 'test_item'}}, '1'), '1234567890', '1')
+    queue.send(queue_message('insert', {'Item': {'id': '1234567891', 'name': 'test_item'}}, '2'), '1234567891', '2')
+    queue.send(queue_message('insert', {'Item': {'id': '1234567890', 'name': 'new_item'}}, '3'), '1234567890', '3')
+    queue.send(queue_message('delete', {'Key': {'id': '1234567891'}}, '4'), '1234567891', '4')
+    return queue.receive_event()
+
+
+@pytest.fixture()
+def table_name() -> str:
+    name = os.environ.get('TABLE_NAME')
+    if name is None:
+        raise KeyError("Missing required environmental variable 'TABLE_NAME'")
+    return name
+
+
+def test_lambda_handler(sqs_event: Dict[str, Any], table_name: str) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+
+    try:
+        response = app.lambda_handler(sqs_event, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert response['batchItemFailures'] == []
+        assert data['messages'] == 4
+        assert data['writes'] == 2
+
+        # Make sure only the last operation of each key has been applied
+        table_response = table.get_item(Key={'id': '1234567890'})
+        assert 'Item' in table_response.keys()
+        assert table_response['Item']['name'] == 'new_item'
+        table_response = table.get_item(Key={'id': '1234567891'})
+        assert 'Item' not in table_response.keys()
+    finally:
+        # Ensure the test items are deleted
+        table.delete_item(Key={'id': '1234567890'})
+        table.delete_item(Key={'id': '1234567891'})
+
+
+def test_lambda_handler_with_invalid_messages(table_name: str) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+    queue = LocalQueue()
+    queue.send(queue_message('insert', {'Item': {'id': '1234567890', 'name': 'test_item'}}, '1'), '1234567890', '1')
+    queue.send('not json', '1234567891', '2')
+    queue.send(queue_message('insert', {'Item': {'id': 1234567892}}, '3'), '1234567892', '3')
+    queue.send(queue_message('insert', {'Item': {'id': '', 'name': 'test_item'}}, '4'), '', '4')
+    queue.send(queue_message('insert', {'Item': {'id': '1234567893', 'name': 'test_item'}}, '5'), '1234567893', '5')
+    sqs_event = queue.receive_event()
+
+    try:
+        # Make sure only the messages which can never be applied are reported
+        response = app.lambda_handler(sqs_event, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['writes'] == 2
+        assert response['batchItemFailures'] == [{'itemIdentifier': record['messageId']}
+                                                 for record in sqs_event['Records'][1:4]]
+        assert 'Item' in table.get_item(Key={'id': '1234567890'}).keys()
+        assert 'Item' in table.get_item(Key={'id': '1234567893'}).keys()
+    finally:
+        # Ensure the test items are deleted
+        table.delete_item(Key={'id': '1234567890'})
+        table.delete_item(Key={'id': '1234567893'})
+
+
+def test_lambda_handler_with_rejected_coalesced_messages(table_name: str) -> None:
+    # Connect to the test DynamoDB table
+    dynamodb = boto3.resource('dynamodb')
+    table = dynamodb.Table(table_name)
+    queue = LocalQueue()
+    queue.send(queue_message('insert', {'Item': {'id': '1234567890', 'name': 'test_item'}}, '1'), '1234567890', '1')
+    queue.send(queue_message('insert', {'Item': {'id': '1234567890', 'name': 'x' * 400 * 1024}}, '2'),
+               '1234567890', '2')
+    queue.send(queue_message('insert', {'Item': {'id': '1234567891', 'name': 'test_item'}}, '3'), '1234567891', '3')
+    sqs_event = queue.receive_event()
+
+    try:
+        # Make sure the valid message superseded by the oversized item is reported too
+        response = app.lambda_handler(sqs_event, None)
+        data = json.loads(response['body'])
+        assert response['statusCode'] == 200
+        assert data['writes'] == 1
+        assert response['batchItemFailures'] == [{'itemIdentifier': record['messageId']}
+                                                 for record in sqs_event['Records'][:2]]
+        assert 'Item' not in table.get_item(Key={'id': '1234567890'}).keys()
+        assert 'Item' in table.get_item(Key={'id': '1234567891'}).keys()
+    finally:
+        # Ensure the test items are deleted
+        table.delete_item(Key={'id': '1234567890'})
+        table.delete_item(Key={'id': '1234567891'})